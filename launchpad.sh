@@ -16,14 +16,10 @@ function CHECK_REQUIREMENT() {
 }
 
 
-LINK_AMIDI='';
 LINK_XDOTOOL='';
-LINK_AMIXER='';
 LINK_PACTL='';
 
-CHECK_REQUIREMENT 'amidi'   $LINK_AMIDI;
 CHECK_REQUIREMENT 'xdotool' $LINK_XDOTOOL;
-CHECK_REQUIREMENT 'amixer'  $LINK_AMIXER;
 CHECK_REQUIREMENT 'pactl'   $LINK_PACTL;
 
 [ $ERROR_CODE -ne 0 ] && exit $ERROR_CODE;
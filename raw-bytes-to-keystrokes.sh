@@ -5,23 +5,37 @@ REQUIREMENT_ERROR="I require %s but it's not installed. (%s)\n\n";
 REQUIREMENT_ERROR_CODE=1;
 
 LINK_XDOTOOL='';
+LINK_SOCAT='';
+LINK_JQ='';
 
 ERROR_CODE=0;
 
 command -v xdotool >/dev/null 2>&1\
 	|| { ERROR_CODE="$REQUIREMENT_ERROR_CODE"; printf "$REQUIREMENT_ERROR" 'xdotool' "$LINK_XDOTOOL" >&2; };
 
+command -v socat >/dev/null 2>&1\
+	|| { ERROR_CODE="$REQUIREMENT_ERROR_CODE"; printf "$REQUIREMENT_ERROR" 'socat' "$LINK_SOCAT" >&2; };
+
+command -v jq >/dev/null 2>&1\
+	|| { ERROR_CODE="$REQUIREMENT_ERROR_CODE"; printf "$REQUIREMENT_ERROR" 'jq' "$LINK_JQ" >&2; };
+
+
+# the driver (rtmidi-launchpad.py) owns the device; we listen in on it
+LAUNCHPAD_SOCKET="${LAUNCHPAD_SOCKET:-${XDG_RUNTIME_DIR:-/tmp/launchpad-$(id -u)}/launchpad.sock}"
+
 
 function RETURN_MIDI_EVENTS() {
 	return 0
 }
 
 function TRIGGER_KEY_EVENTS() {
-	aseqdump -p "Launchpad S" | \
-		while IFS=" ," read src ev1 ev2 ch label1 data1 label2 data2 rest; do
-			case "$ev1 $ev2 $data1" in
-				"Note on 112" ) xdotool type hello ;;
-			esac
+	# a subscription only listens, so the button keeps doing its own job too;
+	# it lasts as long as the connection, so keep our end open
+	{ echo '{"op": "subscribe"}'; sleep infinity; } | \
+		socat - UNIX-CONNECT:"$LAUNCHPAD_SOCKET" | \
+		jq --unbuffered -r 'select(.event == "press" and .note == 112 and .automap == false) | .note' | \
+		while read -r note; do
+			xdotool type hello
 		done
 }
 
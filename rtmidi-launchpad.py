@@ -1,10 +1,40 @@
+import argparse
+import bisect
+import collections
+import contextlib
+import itertools
 import time
 import os
-
-from math import floor
-from subprocess import call
-
-import rtmidi
+import re
+import json
+import queue
+import select
+import socket
+import struct
+import threading
+import traceback
+import ctypes
+import ctypes.util
+
+from math import ceil, floor
+from subprocess import call, check_output, CalledProcessError, Popen, PIPE, DEVNULL
+
+try:
+    import rtmidi
+except ImportError:
+    rtmidi = None # only --simulate and --bench work without it
+
+try:
+    from Xlib import X, XK
+    from Xlib.display import Display
+    from Xlib.ext import xtest
+except ImportError:
+    Display = None
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
 
 
 LAUNCHPAD_COLS = 9
@@ -14,20 +44,59 @@ LAUNCHPAD_ROWS = 8
 ### Application Settings #######################################
 ################################################################
 
-GLOBAL_FLASH_TIME = 0.5
-GLOBAL_FLASH_CYCLE = GLOBAL_FLASH_TIME
-GLOBAL_FLASH_ON = True
-
-PORT_COUNT = 0
-GLOBAL_REFRESH_PORT_SIGNAL = False
+LAUNCHPAD_PORT_NAME = 'Launchpad'
 
+# how often the port list is checked when no hot-plug event wakes us sooner
 APPLICATION_REFRESH_TIME = 0.25
 
-MAX_OUTPUT_VOLUME = 140
-MAX_OUTPUT_LEVEL = LAUNCHPAD_COLS - 1
+# a freshly plugged device takes a moment to show up as a MIDI port
+HOTPLUG_SETTLE_TIMES = [0.01, 0.02, 0.05, 0.1, 0.2, 0.4, 0.8]
+
+AUDIO_RECONNECT_TIME = 1.0
+
+# how long pacmd may take to greet us, and how long to use pactl before trying it again
+AUDIO_CONTROL_GREETING_TIME = 1.0
+AUDIO_CONTROL_RETRY_TIME = 5.0
+
+# how long a change we asked for may go unconfirmed before the audio server's word wins
+AUDIO_CONFIRM_TIME = 1.0
+
+LOCK_KEY_POLL_TIME = 0.25 # only used when XKB indicator events are unavailable
+
+MONITOR_TIME = 1.0 # how often /proc is sampled while a layout has a "monitors" page
+
+MONITOR_NETWORK_MAX = 125000000 # bytes a second (in and out) shown as a full network bar
+
+LAYOUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'layout.json')
+
+LAYOUT_POLL_TIME = 1.0 # only used when inotify is unavailable
+
+METRICS_WRITE_TIME = 10.0 # how often --metrics-file is rewritten
+
+ANIMATION_FRAME_RATE = 50 # frames per second while an effect is playing
+
+# what each device's USB MIDI link is asked to carry; 0 for no limit
+MIDI_MESSAGE_RATE = 2000 # messages per second
+MIDI_MESSAGE_BURST = 100 # sent back to back before the rate applies, about one full frame
+
+TIMER_TICK = 0.005 # resolution of the timer wheel (macros, gestures)
+
+LONG_PRESS_TIME = 0.5 # held this long, a pad with a "long-press" runs that instead
+DOUBLE_TAP_TIME = 0.25 # how long a pad with a "double-tap" waits for the second press
+CHORD_TIME = 0.05 # how far apart the presses of a chord may be
 
-MAX_INPUT_VOLUME = 140
-MAX_INPUT_LEVEL = LAUNCHPAD_COLS - 1
+# where other programs can talk to the driver (see Control Socket); without a
+# runtime directory, a private one of our own rather than the shared /tmp
+CONTROL_SOCKET_FILE = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or '/tmp/launchpad-{0}'.format(os.getuid()), 'launchpad.sock',
+)
+
+# the last frames and system state, shown straight away on the next start (see Snapshots)
+SNAPSHOT_FILE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'launchpad-snapshot.json',
+)
+
+SNAPSHOT_WRITE_TIME = 5.0 # how often the snapshot is rewritten, if anything changed
 
 
 ################################################################
@@ -72,117 +141,463 @@ AUTOMAP_SIGNAL = 176
 
 RESET_LIGHT_SIGNAL = [0xb0, 0x00, 0x00]
 
+AUTOMAP_FIRST_NOTE = 104
+
+# X-Y grid mapping; also rewinds the rapid update cursor to the first LED
+GRID_LAYOUT_SIGNAL = [0xb0, 0x00, 0x01]
+
+# two LEDs per message, in grid / scene column / automap row order
+RAPID_UPDATE = 0x92
+
+# 0b00GG11RR : the 11 asks the device to write both buffers at once
+BOTH_BUFFERS = 0b00001100
+
+# 0b00GG10RR : write one buffer and clear the other, so the LED blinks
+# while the device flips between its buffers on its own
+FLASH_BUFFERS = 0b00001000
+
+is_flashing_velocity = lambda velocity: velocity & BOTH_BUFFERS == FLASH_BUFFERS
+
+def buffer_control(display=0, update=0, flash=False, copy=False):
+    return [AUTOMAP_ON, 0x00, 0b00100000 | copy << 4 | flash << 3 | update << 2 | display]
+
 
 ################################################################
-### Customizable Colors ########################################
+### LED Frame Buffer ###########################################
 ################################################################
 
-BUTTON_FLASH_ON_ACTIVE = {
-    '72': True,
-}
+# Every LED the device has, in rapid-update order:
+#   0 - 63 : the 8x8 grid, row by row
+#  64 - 71 : the right-hand (scene) column
+#  72 - 79 : the automap row
+GRID_LED_COUNT = LAUNCHPAD_ROWS * (LAUNCHPAD_COLS - 1)
+SCENE_LED_COUNT = LAUNCHPAD_ROWS
+AUTOMAP_LED_COUNT = LAUNCHPAD_COLS - 1
+LED_COUNT = GRID_LED_COUNT + SCENE_LED_COUNT + AUTOMAP_LED_COUNT
+
+LED_LOCK = threading.Lock()
+
+class Page(object):
+    # one page of a layout, with the frame it keeps painting while hidden
+    def __init__(self, layout):
+        self.layout = layout
+        self.frame = [None] * LED_COUNT
+        self.levels = {} # volume bar kind (or ('monitor', row)) -> level the frame shows
+
+class TokenBucket(object):
+    # lets through `rate` messages a second on average and `burst` at once
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.perf_counter()
+
+    def take(self):
+        if not self.rate:
+            return
+
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+        if self.tokens < 1:
+            wait = (1 - self.tokens) / self.rate
+            observe('midi_throttle_seconds', wait)
+            time.sleep(wait)
+
+            self.tokens = 1
+            self.stamp = time.perf_counter()
 
-BUTTON_COLORS = {
-    'default': ['BRIGHT_RED', 'DIM_RED'],
-
-    '4' : ['BRIGHT_ORANGE', 'MEDIUM_GREEN'],
-    '20': ['BRIGHT_ORANGE', 'MEDIUM_GREEN'],
-    '52': ['BRIGHT_ORANGE', 'MEDIUM_GREEN'],
-    '53': ['BRIGHT_ORANGE', 'MEDIUM_GREEN'],
-
-    '54': ['BRIGHT_ORANGE', 'YELLOW_GREEN'],
-    '55': ['BRIGHT_ORANGE', 'YELLOW_GREEN'],
-    '36': ['BRIGHT_ORANGE', 'YELLOW_GREEN'],
-
-    '5' : ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '6' : ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '7' : ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '8' : ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '21': ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '22': ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '23': ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '24': ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '37': ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '38': ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '39': ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '40': ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-    '56': ['BRIGHT_ORANGE', 'MEDIUM_RED'],
-}
+        self.tokens -= 1
+
+class Device(object):
+    # one Launchpad: its ports, what its LEDs show and the layout it runs
+    def __init__(self, name, layouts, layout_path, midiout, midiin):
+        self.name = name # connects to the first free port whose name contains this
+        self.layout_path = layout_path
 
-BUTTON_COLORS['automap'] = {
-    '104': ['BRIGHT_GREEN', 'MEDIUM_YELLOW'],
-    '105': ['BRIGHT_AMBER', 'MEDIUM_YELLOW'],
+        self.midiout = midiout
+        self.midiin = midiin
+        self.port_name = None # name of the port we are connected to, if any
 
-    '107': ['BRIGHT_ORANGE', 'MEDIUM_AMBER'],
-    '108': ['BRIGHT_ORANGE', 'MEDIUM_YELLOW'],
-    '109': ['BRIGHT_ORANGE', 'MEDIUM_AMBER'],
+        self.sent = [None] * LED_COUNT  # what the device was last told to show
+        self.budget = TokenBucket(MIDI_MESSAGE_RATE, MIDI_MESSAGE_BURST)
 
-    '111': ['BRIGHT_RED', 'MEDIUM_ORANGE'],
-    'default': [ 'YELLOW_GREEN', 'DIM_GREEN' ],
-}
+        self.effects = [] # animations playing over the frame, bottom first
+        self.overlay = [None] * LED_COUNT # what they currently cover the frame with
 
-BUTTON_COLORS['source'] = {
-    'default': BUTTON_COLORS['default'][1],
-    'no-volume': 'BRIGHT_AMBER',
-    'toggle': ['BRIGHT_RED', 'DIM_AMBER'],
-    'levels': [
-        'MEDIUM_RED', 'MEDIUM_RED',
-        'MEDIUM_AMBER', 'MEDIUM_AMBER', 'MEDIUM_AMBER',
-        'BRIGHT_AMBER', 'BRIGHT_AMBER',
-        'BRIGHT_YELLOW', 'BRIGHT_YELLOW',
-    ],
-}
+        # the shown page's layout, frame (what the device should be showing) and levels
+        self.pages = [Page(layout) for layout in layouts]
+        self.select(0)
+
+    def select(self, number):
+        self.page = number % len(self.pages)
+        page = self.pages[self.page]
+        self.layout, self.frame, self.levels = page.layout, page.frame, page.levels
+
+    def views(self):
+        # everything state changes are painted into: the device for the shown
+        # page, and the hidden pages themselves
+        return [self] + [page for number, page in enumerate(self.pages) if number != self.page]
+
+DEVICES = [] # all of them are served by the same threads
 
-BUTTON_COLORS['sink'] = {
-    'default': BUTTON_COLORS['default'][1],
-    'no-volume': 'BRIGHT_RED',
-    'toggle': ['BRIGHT_GREEN', 'DIM_GREEN'],
-    'levels': [
-        'BRIGHT_GREEN', 'BRIGHT_GREEN', 'BRIGHT_GREEN',
-        'YELLOW_GREEN', 'YELLOW_GREEN',
-        'BRIGHT_YELLOW',
-        'BRIGHT_RED', 'BRIGHT_RED', 'BRIGHT_RED',
-    ],
+def grid_led_index(note):
+    row, col = note >> 4, note & 0x0f
+
+    if col < LAUNCHPAD_COLS - 1:
+        return row * (LAUNCHPAD_COLS - 1) + col
+    if col == LAUNCHPAD_COLS - 1:
+        return GRID_LED_COUNT + row
+    return None # e.g. an automap note passed through bind_key
+
+automap_led_index = lambda note: GRID_LED_COUNT + SCENE_LED_COUNT + note - AUTOMAP_FIRST_NOTE
+
+def led_message(index, velocity):
+    if index < GRID_LED_COUNT:
+        row, col = divmod(index, LAUNCHPAD_COLS - 1)
+        return [LIGHT_ON, row * 16 + col, velocity]
+
+    if index < GRID_LED_COUNT + SCENE_LED_COUNT:
+        row = index - GRID_LED_COUNT
+        return [LIGHT_ON, row * 16 + LAUNCHPAD_COLS - 1, velocity]
+
+    return [AUTOMAP_ON, AUTOMAP_FIRST_NOTE + index - GRID_LED_COUNT - SCENE_LED_COUNT, velocity]
+
+def send_midi(device, message):
+    device.budget.take()
+    device.midiout.send_message(message)
+    count('midi_messages_total')
+
+def write_changed_leds(device):
+    # only LEDs which differ from what the device already shows are sent, so
+    # however often an LED was repainted while waiting, only its latest color goes out
+    sent = device.sent
+    overlay = device.overlay
+
+    for index, velocity in enumerate(device.frame):
+        if overlay[index] is not None:
+            velocity = overlay[index]
+
+        if velocity is None or velocity == sent[index]:
+            continue
+
+        send_midi(device, led_message(index, velocity))
+        sent[index] = velocity
+
+def write_frame(device):
+    # paint every LED into the hidden buffer, then flip it into view at once
+    shown = [below if above is None else above for below, above in zip(device.frame, device.overlay)]
+    frame = [COLORS['OFF'] if v is None else v for v in shown]
+    hidden = [velocity & ~BOTH_BUFFERS for velocity in frame]
+
+    send_midi(device, buffer_control(display=0, update=1))
+    send_midi(device, GRID_LAYOUT_SIGNAL)
+
+    for index in range(0, LED_COUNT, 2):
+        send_midi(device, [RAPID_UPDATE, hidden[index], hidden[index + 1]])
+
+    # show the new frame, copy it into the other buffer, then carry on as usual
+    send_midi(device, buffer_control(display=1, update=0, copy=True))
+    send_midi(device, buffer_control(flash=True))
+
+    # the copy made both buffers agree, so blinking LEDs need to be split again
+    for index, velocity in enumerate(frame):
+        if is_flashing_velocity(velocity):
+            send_midi(device, led_message(index, velocity))
+
+    device.sent[:] = frame
+
+def write_reset(device):
+    send_midi(device, RESET_LIGHT_SIGNAL)
+    send_midi(device, buffer_control(flash=True))
+
+    device.sent[:] = [COLORS['OFF']] * LED_COUNT
+
+
+# --------------------------------------------------------------
+# LED writer
+# --------------------------------------------------------------
+
+# the writer thread is the only one which talks to the output ports; everyone
+# else paints into a device's frame and asks for it to be written
+LED_WRITES = queue.PriorityQueue()
+
+LED_WRITERS = {
+    'changed': write_changed_leds,
+    'frame': write_frame,
+    'reset': write_reset,
 }
 
+# a pad's feedback jumps ahead of repaints nobody is waiting on (animations,
+# other devices catching up, audio changes made elsewhere)
+LED_PRIORITY_PRESS = 0
+LED_PRIORITY_BACKGROUND = 1
+
+# Every write covers whatever was painted before it runs, and a frame covers
+# any changed LEDs too, so a request which is already waiting is not queued
+# again. A press does not wait behind a background write of the same kind: it
+# queues its own, and the background one is dropped when it comes up, because
+# the press's write started after it was asked for. So the queue holds at most
+# one write of each kind and priority per device, however fast frames are painted.
+LED_PENDING = set() # (device, request, priority) of every write waiting in the queue
+LED_STARTED = {} # (device, request) -> sequence number taken when its last write started
+LED_PENDING_LOCK = threading.Lock()
+LED_SEQUENCE = itertools.count() # first come, first served within a priority
+
+def led_write_pending(device, request, priority=LED_PRIORITY_BACKGROUND):
+    # at this priority or a better one
+    return any((device, request, better) in LED_PENDING for better in range(priority + 1))
+
+def request_leds(device, request, received=None):
+    priority = LED_PRIORITY_BACKGROUND if received is None else LED_PRIORITY_PRESS
+
+    with LED_PENDING_LOCK:
+        # sending changes ahead of a frame would tear it, so the frame goes first instead
+        if request == 'changed' and led_write_pending(device, 'frame'):
+            request = 'frame'
+
+        if led_write_pending(device, request, priority):
+            count('led_writes_coalesced_total')
+            return
+        LED_PENDING.add((device, request, priority))
+
+        # put under the lock, so the sequence is the order requests were made in
+        LED_WRITES.put((priority, next(LED_SEQUENCE), device, request, received))
+
+# flushes caused by a pad press carry its arrival time, to measure press-to-LED
+flush_leds = lambda device, received=None: request_leds(device, 'changed', received)
+send_frame = lambda device: request_leds(device, 'frame')
+reset_leds = lambda device: request_leds(device, 'reset')
+
+def led_write_covered(device, request, sequence):
+    started = lambda kind: LED_STARTED.get((device, kind), -1) > sequence
+    return started(request) or request == 'changed' and started('frame')
+
+def write_leds():
+    while True:
+        priority, sequence, device, request, received = LED_WRITES.get()
+
+        with LED_PENDING_LOCK:
+            # anything painted from here on needs a write of its own
+            LED_PENDING.discard((device, request, priority))
+
+            covered = led_write_covered(device, request, sequence)
+            if not covered:
+                LED_STARTED[(device, request)] = next(LED_SEQUENCE)
+
+        try:
+            with LED_LOCK:
+                # a frame may have been asked for while this waited for the lock
+                with LED_PENDING_LOCK:
+                    covered = covered or request == 'changed' and led_write_pending(device, 'frame')
+
+                if covered:
+                    count('led_writes_coalesced_total')
+                elif device.midiout.is_port_open():
+                    sent = counter_value('midi_messages_total')
+
+                    with timed('midi_write_seconds', (('request', request),)):
+                        LED_WRITERS[request](device)
+
+                    if received is not None and counter_value('midi_messages_total') != sent:
+                        observe('press_to_led_seconds', time.perf_counter() - received)
+        except Exception: # pylint: disable=broad-except
+            traceback.print_exc()
+
+        LED_WRITES.task_done()
+
+def start_led_writer():
+    writer = threading.Thread(target=write_leds, name='led-writer')
+    writer.daemon = True
+    writer.start()
+
 
 ################################################################
 ### Launchpad S API Helpers ####################################
 ################################################################
 
-is_flashing_button = lambda note: BUTTON_FLASH_ON_ACTIVE.get(str(note), False)
 is_active_signal = lambda byte_signal: byte_signal[2] == ACTIVE_SIGNAL
 
-def color_button(byte_signal=None, colors=None):
+def color_button(device, byte_signal=None, colors=None):
     active = is_keydown(byte_signal)
 
     note = byte_signal[1]
+    layout = device.layout
 
     if colors is None:
-        colors = BUTTON_COLORS.get(str(note), BUTTON_COLORS['default'])
-
-    color = COLORS[colors[0] if active else colors[1]]
-
-    if GLOBAL_FLASH_ON or not active or not is_flashing_button(note):
-        signal = LIGHT_ON
+        velocity = layout.note_velocities[active][note]
     else:
-        signal = LIGHT_OFF
+        velocity = button_velocity(note, colors[0] if active else colors[1], active, layout.flash)
 
-    midiout.send_message([signal, note, color])
+    index = GRID_LED_INDEX[note]
+    if index is not None:
+        device.frame[index] = velocity
 
 
-def color_automap_button(byte_signal, force_default=False):
+def color_automap_button(device, byte_signal, force_default=False):
     active = is_active_signal(byte_signal)
 
     note = byte_signal[1]
 
-    colors = BUTTON_COLORS['automap'].get(
-        'default' if force_default else str(note),
-        BUTTON_COLORS['automap']['default']
-    )
+    if force_default:
+        velocities = device.layout.automap_default_velocities
+    else:
+        velocities = device.layout.automap_velocities
+
+    index = AUTOMAP_LED_INDEX[note]
+    if index is not None:
+        device.frame[index] = velocities[active][note]
+
+def color_pad(device, byte_signal):
+    # pylint: disable=expression-not-assigned
+    (color_automap_button if is_automap_key(byte_signal) else color_button)(device, byte_signal)
 
-    color = COLORS[colors[0] if active else colors[1]]
+def paint_leds(device, leds):
+    frame = device.frame
+    for index, velocity in leds:
+        frame[index] = velocity
 
-    midiout.send_message([AUTOMAP_ON, note, color])
+
+################################################################
+### Metrics ####################################################
+################################################################
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+]
+
+METRICS_PREFIX = 'launchpad_'
+
+HISTOGRAMS = {} # (name, labels) -> Histogram
+COUNTERS = {}   # (name, labels) -> running total
+METRICS_LOCK = threading.Lock()
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1) # the last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+def observe(name, seconds, labels=()):
+    with METRICS_LOCK:
+        histogram = HISTOGRAMS.get((name, labels))
+        if histogram is None:
+            histogram = HISTOGRAMS[(name, labels)] = Histogram()
+        histogram.observe(seconds)
+
+def count(name, labels=(), amount=1):
+    with METRICS_LOCK:
+        COUNTERS[(name, labels)] = COUNTERS.get((name, labels), 0) + amount
+
+counter_value = lambda name, labels=(): COUNTERS.get((name, labels), 0)
+
+@contextlib.contextmanager
+def timed(name, labels=()):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, labels)
+
+def binding_labels(byte_signal):
+    row = 'automap' if is_automap_key(byte_signal) else 'grid'
+    return (('row', row), ('note', str(byte_signal[1])))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, value) for key, value in labels) + '}'
+
+def format_metrics():
+    # Prometheus text exposition format
+    with METRICS_LOCK:
+        histograms = [
+            (key, list(histogram.buckets), histogram.total, histogram.count)
+            for key, histogram in sorted(HISTOGRAMS.items())
+        ]
+        counters = sorted(COUNTERS.items())
+
+    lines = []
+    typed = set()
+
+    for (name, labels), buckets, total, observed in histograms:
+        metric = METRICS_PREFIX + name
+        if metric not in typed:
+            lines.append('# TYPE {0} histogram'.format(metric))
+            typed.add(metric)
+
+        cumulative = 0
+        for bound, bucket in zip(LATENCY_BUCKETS + ['+Inf'], buckets):
+            cumulative += bucket
+            bucket_labels = format_labels(labels + (('le', bound),))
+            lines.append('{0}_bucket{1} {2}'.format(metric, bucket_labels, cumulative))
+
+        lines.append('{0}_sum{1} {2}'.format(metric, format_labels(labels), total))
+        lines.append('{0}_count{1} {2}'.format(metric, format_labels(labels), observed))
+
+    for (name, labels), value in counters:
+        metric = METRICS_PREFIX + name
+        if metric not in typed:
+            lines.append('# TYPE {0} counter'.format(metric))
+            typed.add(metric)
+
+        lines.append('{0}{1} {2}'.format(metric, format_labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+def write_metrics_file(path):
+    # replaced in one go, so a textfile collector never reads half a file
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as metrics:
+        metrics.write(format_metrics())
+    os.replace(temporary, path)
+
+def export_metrics_file(path):
+    while True:
+        time.sleep(METRICS_WRITE_TIME)
+        try:
+            write_metrics_file(path)
+        except OSError:
+            traceback.print_exc()
+
+def serve_metrics_socket(path):
+    # every connection gets the current metrics, e.g. `socat - UNIX-CONNECT:path`
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(4)
+
+    while True:
+        client, _ = server.accept()
+        with client:
+            try:
+                client.sendall(format_metrics().encode())
+            except OSError:
+                pass
+
+def start_metrics_export(metrics_file=None, metrics_socket=None):
+    exporters = [
+        (export_metrics_file, metrics_file, 'metrics-file'),
+        (serve_metrics_socket, metrics_socket, 'metrics-socket'),
+    ]
+
+    for target, path, name in exporters:
+        if path is None:
+            continue
+
+        exporter = threading.Thread(target=target, args=(path,), name=name)
+        exporter.daemon = True
+        exporter.start()
 
 
 ################################################################
@@ -195,29 +610,52 @@ def fix_value_to_bounds(val, lower, upper):
     return upper if val > upper else val
 
 def restart_pulse_audio():
-    call(['pulseaudio', '-k'])
+    run_command(['pulseaudio', '-k'])
+
+def run_command(args, output=False):
+    # every short-lived child goes through here so it shows up in the metrics
+    labels = (('command', args[0]),)
+    count('process_spawns_total', labels)
+
+    with timed('subprocess_seconds', labels):
+        if SIMULATED_SYSTEM is not None:
+            return SIMULATED_SYSTEM.run(args, output)
+        if output:
+            return check_output(args, universal_newlines=True)
+        return call(args)
+
+def spawn_command(args, **kwargs):
+    count('process_spawns_total', (('command', args[0]),))
+
+    if SIMULATED_SYSTEM is not None:
+        return SIMULATED_SYSTEM.spawn(args, **kwargs)
+    return Popen(args, **kwargs)
+
+def toggle_lock_key(lock, key):
+    # assume the toggle worked; the lock-key watcher reports otherwise
+    LOCK_KEY_STATE[lock] = not LOCK_KEY_STATE[lock]
+    KEY_INJECTOR.key(key)
 
 def num_lock(toggle=False):
     if toggle:
-        call(['xdotool', 'key', 'Num_Lock'])
+        toggle_lock_key('num', 'Num_Lock')
 
-    cmd = 'xset q | grep -q "Num Lock:\\s*on" && echo 1'
-    return bool(os.popen(cmd).read())
+    return bool(LOCK_KEY_STATE['num'])
 
 def caps_lock(toggle=False):
     if toggle:
-        call(['xdotool', 'key', 'Caps_Lock'])
+        toggle_lock_key('caps', 'Caps_Lock')
 
-    cmd = 'xset q | grep -q "Caps Lock:\\s*on" && echo 1'
-    return bool(os.popen(cmd).read())
+    return bool(LOCK_KEY_STATE['caps'])
 
-def bind_key(byte_signal, key):
+def bind_key(device, byte_signal, key):
     # pylint: disable=expression-not-assigned
     keydown(key) if is_keydown(byte_signal) else keyup(key)
-    color_button(byte_signal)
+    color_button(device, byte_signal)
 
-keydown = lambda key: call(['xdotool', 'keydown', key])
-keyup = lambda key: call(['xdotool', 'keyup', key])
+keydown = lambda key: KEY_INJECTOR.keydown(key)
+keyup = lambda key: KEY_INJECTOR.keyup(key)
+type_text = lambda text: KEY_INJECTOR.type(text)
 
 
 is_keydown = is_active_signal
@@ -227,431 +665,3320 @@ generate_fake_midi_signal = lambda note=0, on=True: [0,note,127 if on else 0]
 
 
 ################################################################
-### Keybindings and Keybound Actions ###########################
+### Timer Wheel ################################################
 ################################################################
 
-HOLD_BINDINGS = {} # handles both keyup / keydown
-KEYBINDINGS = {} # only triggered on keydown
+# Timers live in a hierarchical wheel: level n has 64 slots, each 64**n ticks
+# wide. A timer is filed under the lowest level on which it still differs from
+# the current tick and falls down a level whenever the wheel comes round to its
+# slot, so scheduling, cancelling and firing all cost the same however many
+# timers are pending. One thread turns the wheel and sleeps while it is empty.
+TIMER_WHEEL_BITS = 6
+TIMER_WHEEL_MASK = (1 << TIMER_WHEEL_BITS) - 1
+TIMER_WHEEL_LEVELS = 4 # 64**4 ticks is over half a day at 5ms a tick
+
+class Timer(object):
+    def __init__(self, due, callback):
+        self.due = due # in ticks
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        # it stays in its slot and is dropped when the wheel gets there
+        self.cancelled = True
+
+class TimerWheel(object):
+    def __init__(self, tick=TIMER_TICK):
+        self.tick = tick
+        self.slots = [[[] for _ in range(TIMER_WHEEL_MASK + 1)] for _ in range(TIMER_WHEEL_LEVELS)]
+        self.now = 0 # ticks since start
+        self.start = time.perf_counter()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+        # started on first use, like the action lanes
+        self.thread = threading.Thread(target=self.run, name='timer-wheel')
+        self.thread.daemon = True
+
+    def schedule(self, delay, callback):
+        # callback runs on the wheel's thread, so it should only hand work off
+        with self.lock:
+            if not self.thread.is_alive():
+                self.thread.start()
+
+            if not self.pending:
+                # the wheel stops turning while it is empty; catch up with the clock
+                self.now = int((time.perf_counter() - self.start) / self.tick)
+
+            timer = Timer(self.now + max(1, ceil(delay / self.tick)), callback)
+            self.insert(timer)
+            self.pending += 1
+
+        self.wakeup.set()
+        return timer
+
+    def insert(self, timer):
+        level = 0
+        while level < TIMER_WHEEL_LEVELS - 1:
+            shift = TIMER_WHEEL_BITS * (level + 1)
+            if timer.due >> shift == self.now >> shift:
+                break
+            level += 1
+
+        slot = (timer.due >> (TIMER_WHEEL_BITS * level)) & TIMER_WHEEL_MASK
+        self.slots[level][slot].append(timer)
+
+    def advance(self):
+        # one tick forward: cascade the higher levels, then empty the current slot
+        self.now += 1
+
+        for level in range(TIMER_WHEEL_LEVELS - 1, 0, -1):
+            shift = TIMER_WHEEL_BITS * level
+            if self.now & ((1 << shift) - 1):
+                continue
+
+            slots = self.slots[level]
+            index = (self.now >> shift) & TIMER_WHEEL_MASK
+            timers, slots[index] = slots[index], []
+
+            for timer in timers:
+                if timer.cancelled:
+                    self.pending -= 1
+                else:
+                    self.insert(timer)
+
+        slots = self.slots[0]
+        index = self.now & TIMER_WHEEL_MASK
+        due, slots[index] = slots[index], []
+        self.pending -= len(due)
+
+        return [timer for timer in due if not timer.cancelled]
+
+    def run(self):
+        while True:
+            with self.lock:
+                idle = not self.pending
+                if idle:
+                    self.wakeup.clear()
 
-AUTOMAP = {} # automap row is handled differently from other rows
+            if idle:
+                self.wakeup.wait()
+                continue
 
+            delay = self.start + (self.now + 1) * self.tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
 
-# --------------------------------------------------------------
-# Basic keybindings
-# --------------------------------------------------------------
+            with self.lock:
+                due = self.advance()
 
-# tenkeypad
-HOLD_BINDINGS['4']  = lambda byte_signal: bind_key(byte_signal, '0')
-HOLD_BINDINGS['5']  = lambda byte_signal: bind_key(byte_signal, '1')
-HOLD_BINDINGS['6']  = lambda byte_signal: bind_key(byte_signal, '4')
-HOLD_BINDINGS['7']  = lambda byte_signal: bind_key(byte_signal, '7')
-HOLD_BINDINGS['8']  = lambda byte_signal: bind_key(byte_signal, 'equal')
-HOLD_BINDINGS['20'] = lambda byte_signal: bind_key(byte_signal, '0')
-HOLD_BINDINGS['21'] = lambda byte_signal: bind_key(byte_signal, '2')
-HOLD_BINDINGS['22'] = lambda byte_signal: bind_key(byte_signal, '5')
-HOLD_BINDINGS['23'] = lambda byte_signal: bind_key(byte_signal, '8')
-HOLD_BINDINGS['24'] = lambda byte_signal: bind_key(byte_signal, 'slash')
-HOLD_BINDINGS['36'] = lambda byte_signal: bind_key(byte_signal, 'period')
-HOLD_BINDINGS['37'] = lambda byte_signal: bind_key(byte_signal, '3')
-HOLD_BINDINGS['38'] = lambda byte_signal: bind_key(byte_signal, '6')
-HOLD_BINDINGS['39'] = lambda byte_signal: bind_key(byte_signal, '9')
-HOLD_BINDINGS['40'] = lambda byte_signal: bind_key(byte_signal, 'asterisk')
-HOLD_BINDINGS['52'] = lambda byte_signal: bind_key(byte_signal, 'Return')
-HOLD_BINDINGS['53'] = lambda byte_signal: bind_key(byte_signal, 'Return')
-HOLD_BINDINGS['54'] = lambda byte_signal: bind_key(byte_signal, 'plus')
-HOLD_BINDINGS['55'] = lambda byte_signal: bind_key(byte_signal, 'plus')
-HOLD_BINDINGS['56'] = lambda byte_signal: bind_key(byte_signal, 'minus')
+            for timer in due:
+                try:
+                    timer.callback()
+                except Exception: # pylint: disable=broad-except
+                    traceback.print_exc()
 
+TIMERS = TimerWheel()
 
-# --------------------------------------------------------------
-# Automap keybindings
-# --------------------------------------------------------------
 
-def toggle_num_lock(byte_signal):
-    if is_keydown(byte_signal):
-        color_automap_button(
-            generate_fake_midi_signal(
-                note=byte_signal[1],
-                on=num_lock(toggle=True),
-            )
-        )
+################################################################
+### Key Injection ##############################################
+################################################################
 
-def toggle_caps_lock(byte_signal):
-    if is_keydown(byte_signal):
-        color_automap_button(
-            generate_fake_midi_signal(
-                note=byte_signal[1],
-                on=caps_lock(toggle=True),
-            )
-        )
+# keysym names for characters which are not their own name
+CHARACTER_KEYSYMS = {
+    ' ': 'space', '\n': 'Return', '\t': 'Tab',
+    '!': 'exclam', '"': 'quotedbl', '#': 'numbersign', '$': 'dollar', '%': 'percent',
+    '&': 'ampersand', "'": 'apostrophe', '(': 'parenleft', ')': 'parenright',
+    '*': 'asterisk', '+': 'plus', ',': 'comma', '-': 'minus', '.': 'period',
+    '/': 'slash', ':': 'colon', ';': 'semicolon', '<': 'less', '=': 'equal',
+    '>': 'greater', '?': 'question', '@': 'at', '[': 'bracketleft',
+    '\\': 'backslash', ']': 'bracketright', '^': 'asciicircum', '_': 'underscore',
+    '`': 'grave', '{': 'braceleft', '|': 'bar', '}': 'braceright', '~': 'asciitilde',
+}
 
-def restart_audio_engine(byte_signal):
-    restart_pulse_audio()
-    color_automap_button(byte_signal)
+character_keysym = lambda character: CHARACTER_KEYSYMS.get(character, character)
 
-def play_pause(byte_signal):
-    color_automap_button(byte_signal)
-    bind_key(byte_signal, 'XF86AudioPlay')
+class XTestInjector(object):
+    # one X connection for the life of the driver; keys are faked through XTEST
+    def __init__(self, display=None):
+        self.display = Display(display)
+        self.shift = self.display.keysym_to_keycode(XK.string_to_keysym('Shift_L'))
+        self.keycodes = {}
+        self.lock = threading.Lock()
 
-def next_song(byte_signal):
-    color_automap_button(byte_signal)
-    bind_key(byte_signal, 'XF86AudioNext')
+        XK.load_keysym_group('xf86')
 
-def prev_song(byte_signal):
-    color_automap_button(byte_signal)
-    bind_key(byte_signal, 'XF86AudioPrev')
+    def keycode(self, key):
+        if key not in self.keycodes:
+            keysym = XK.string_to_keysym(key)
 
-AUTOMAP['default'] = color_automap_button
-AUTOMAP['104'] = toggle_num_lock
-AUTOMAP['105'] = toggle_caps_lock
-#AUTOMAP['106'] =
-AUTOMAP['107'] = prev_song
-AUTOMAP['108'] = play_pause
-AUTOMAP['109'] = next_song
-#AUTOMAP['110'] =
-AUTOMAP['111'] = restart_audio_engine
+            # xdotool says XF86AudioPlay where python-xlib says XF86_AudioPlay
+            if not keysym and key.startswith('XF86'):
+                keysym = XK.string_to_keysym('XF86_' + key[4:])
 
+            # prefer an unshifted keycode (e.g. KP_Add for 'plus') when there is one
+            keycodes = sorted(self.display.keysym_to_keycodes(keysym), key=lambda k: k[1])
+            keycode, index = keycodes[0] if keycodes else (0, 0)
 
-# --------------------------------------------------------------
-# Default system microphone controls
-# --------------------------------------------------------------
+            self.keycodes[key] = (keycode, index % 2 == 1)
 
-def pulse_default_source_volume_control(level, set_volume=True):
-    INDICES = { 'main': [80, 88], 'staggered': [64, 71] }
+        return self.keycodes[key]
 
-    level = fix_value_to_bounds(level, 0, MAX_INPUT_LEVEL)
+    def fake(self, key, event_types):
+        keycode, shifted = self.keycode(key)
 
-    if set_volume:
-        volume = '{0}%'.format(floor(MAX_INPUT_VOLUME * level/MAX_INPUT_LEVEL))
-        call(['pactl', 'set-source-volume', '@DEFAULT_SOURCE@', volume])
+        if not keycode:
+            return
 
-    get_active_colors = lambda x: [
-        BUTTON_COLORS['source']['levels'][x] if level > 0 else BUTTON_COLORS['source']['no-volume'],
-        None
-    ]
+        with self.lock:
+            for event_type in event_types:
+                if shifted and event_type == X.KeyPress:
+                    xtest.fake_input(self.display, X.KeyPress, self.shift)
 
-    for x in range(level + 1):
-        main_index = INDICES['main'][0] + x
-        staggered_index = fix_value_to_bounds(
-            INDICES['staggered'][0] + x - 1,
-            INDICES['staggered'][0],
-            INDICES['staggered'][1],
-        )
+                xtest.fake_input(self.display, event_type, keycode)
 
-        active_colors = get_active_colors(x)
+                if shifted and event_type == X.KeyRelease:
+                    xtest.fake_input(self.display, X.KeyRelease, self.shift)
 
-        for note in [main_index, staggered_index]:
-            color_button(
-                generate_fake_midi_signal(note=note, on=True),
-                colors=active_colors
-            )
+            self.display.sync()
 
-    inactive_colors = [None, BUTTON_COLORS['source']['default']]
+    def keydown(self, key):
+        self.fake(key, [X.KeyPress])
 
-    for x in range(MAX_INPUT_LEVEL - level):
-        main_index = INDICES['main'][1] - x
-        staggered_index = fix_value_to_bounds(
-            INDICES['staggered'][1] - x,
-            INDICES['staggered'][0] + 1,
-            INDICES['staggered'][1],
-        )
+    def keyup(self, key):
+        self.fake(key, [X.KeyRelease])
 
-        for note in [main_index, staggered_index]:
-            color_button(
-                generate_fake_midi_signal(note=note, on=False),
-                colors=inactive_colors
-            )
+    def key(self, key):
+        self.fake(key, [X.KeyPress, X.KeyRelease])
 
-def pulse_default_source_toggle(toggle=True):
-    cmd = 'amixer -D pulse get Capture | grep -q off && echo 1'
-    is_muted = bool(os.popen(cmd).read())
+    def type(self, text):
+        for character in text:
+            self.key(character_keysym(character))
 
-    if toggle:
-        call(['amixer', '-D', 'pulse', 'set', 'Capture', 'toggle'])
-        is_muted = not is_muted
 
-    color_button(
-        generate_fake_midi_signal(note=72, on=not is_muted),
-        colors=BUTTON_COLORS['source']['toggle'],
-    )
+class XdotoolInjector(object):
+    # fallback when python-xlib is unavailable; forks once per key event
+    def __init__(self):
+        self.lock = threading.Lock()
 
-KEYBINDINGS['80'] = lambda byte_signal: pulse_default_source_volume_control(0)
-KEYBINDINGS['81'] = lambda byte_signal: pulse_default_source_volume_control(1)
-KEYBINDINGS['82'] = lambda byte_signal: pulse_default_source_volume_control(2)
-KEYBINDINGS['83'] = lambda byte_signal: pulse_default_source_volume_control(3)
-KEYBINDINGS['84'] = lambda byte_signal: pulse_default_source_volume_control(4)
-KEYBINDINGS['85'] = lambda byte_signal: pulse_default_source_volume_control(5)
-KEYBINDINGS['86'] = lambda byte_signal: pulse_default_source_volume_control(6)
-KEYBINDINGS['87'] = lambda byte_signal: pulse_default_source_volume_control(7)
-KEYBINDINGS['88'] = lambda byte_signal: pulse_default_source_volume_control(8)
-
-KEYBINDINGS['64'] = KEYBINDINGS['80']
-KEYBINDINGS['65'] = KEYBINDINGS['81']
-KEYBINDINGS['66'] = KEYBINDINGS['82']
-KEYBINDINGS['67'] = KEYBINDINGS['83']
-KEYBINDINGS['68'] = KEYBINDINGS['84']
-KEYBINDINGS['69'] = KEYBINDINGS['85']
-KEYBINDINGS['70'] = KEYBINDINGS['86']
-KEYBINDINGS['71'] = KEYBINDINGS['87']
-KEYBINDINGS['72'] = lambda byte_signal: pulse_default_source_toggle()
+    def xdotool(self, *args):
+        with self.lock:
+            run_command(['xdotool'] + list(args))
 
+    def keydown(self, key):
+        self.xdotool('keydown', key)
 
-# --------------------------------------------------------------
-# Default system speaker controls
-# --------------------------------------------------------------
+    def keyup(self, key):
+        self.xdotool('keyup', key)
 
-def system_default_sink_volume_control(level, set_volume=True):
-    INDICES = { 'main': [96, 104], 'staggered': [112, 119] }
+    def key(self, key):
+        self.xdotool('key', key)
 
-    level = MAX_OUTPUT_LEVEL if level > MAX_OUTPUT_LEVEL else level
+    def type(self, text):
+        self.xdotool('type', '--', text)
 
-    if set_volume:
-        volume = '{0}%'.format(floor(MAX_OUTPUT_VOLUME * level/MAX_OUTPUT_LEVEL))
-        call(['pactl', 'set-sink-volume', '@DEFAULT_SINK@', volume])
 
-    get_active_colors = lambda x: [
-        BUTTON_COLORS['sink']['levels'][x] if level > 0 else BUTTON_COLORS['sink']['no-volume'],
-        None
-    ]
+class RecordingInjector(object):
+    # stands in for a real injector when there is no X session to talk to
+    def __init__(self):
+        self.events = []
 
-    for x in range(level + 1):
-        main_index = INDICES['main'][0] + x
-        staggered_index = fix_value_to_bounds(
-            INDICES['staggered'][0] + x - 1,
-            INDICES['staggered'][0],
-            INDICES['staggered'][1],
-        )
+    def keydown(self, key):
+        self.events.append(('keydown', key))
 
-        active_colors = get_active_colors(x)
+    def keyup(self, key):
+        self.events.append(('keyup', key))
 
-        for note in [main_index, staggered_index]:
-            color_button(
-                byte_signal=generate_fake_midi_signal(note=note, on=True),
-                colors=active_colors
-            )
+    def key(self, key):
+        self.keydown(key)
+        self.keyup(key)
 
-    inactive_colors = [None, BUTTON_COLORS['sink']['default']]
+    def type(self, text):
+        for character in text:
+            self.key(character_keysym(character))
 
-    for x in range(MAX_INPUT_LEVEL - level):
-        main_index = INDICES['main'][1] - x
-        staggered_index = fix_value_to_bounds(
-            INDICES['staggered'][1] - x,
-            INDICES['staggered'][0] + 1,
-            INDICES['staggered'][1],
-        )
 
-        for note in [main_index, staggered_index]:
-            color_button(
-                byte_signal=generate_fake_midi_signal(note=note, on=False),
-                colors=inactive_colors
-            )
+def open_key_injector(display=None):
+    if Display is not None:
+        try:
+            return XTestInjector(display)
+        except Exception: # pylint: disable=broad-except
+            pass
 
+    return XdotoolInjector()
 
-def system_default_sink_toggle(toggle=True):
-    cmd = 'amixer -D pulse get Master | grep -q off && echo 1'
-    is_muted = bool(os.popen(cmd).read())
+KEY_INJECTOR = XdotoolInjector()
 
-    if toggle:
-        call(['amixer', '-D', 'pulse', 'set', 'Master', 'toggle'])
-        is_muted = not is_muted
 
-    color_button(
-        generate_fake_midi_signal(note=120, on=not is_muted),
-        colors=BUTTON_COLORS['sink']['toggle'],
+################################################################
+### Keyboard Lock State ########################################
+################################################################
+
+LOCK_KEY_STATE = { 'num': None, 'caps': None }
+
+LOCK_KEY_LISTENERS = [] # called whenever a lock key changes state
+
+# bits of the core keyboard indicator state (the "LED mask" in `xset q`)
+LOCK_KEY_INDICATORS = { 'caps': 1 << 0, 'num': 1 << 1 }
+
+XKB_USE_CORE_KBD = 0x0100
+XKB_INDICATOR_STATE_NOTIFY_MASK = 1 << 4
+XEVENT_SIZE = 24 * ctypes.sizeof(ctypes.c_long)
+
+def set_lock_key_state(state):
+    changed = [lock for lock in state if LOCK_KEY_STATE[lock] != state[lock]]
+
+    LOCK_KEY_STATE.update(state)
+
+    if changed:
+        for listener in LOCK_KEY_LISTENERS:
+            listener(changed)
+
+def open_xkb_display():
+    library = ctypes.util.find_library('X11')
+    if not library:
+        return None, None
+
+    libx11 = ctypes.CDLL(library)
+    libx11.XOpenDisplay.restype = ctypes.c_void_p
+    libx11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+    libx11.XkbQueryExtension.argtypes = [ctypes.c_void_p] + [ctypes.POINTER(ctypes.c_int)] * 5
+    libx11.XkbSelectEvents.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.c_ulong, ctypes.c_ulong]
+    libx11.XkbGetIndicatorState.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.POINTER(ctypes.c_uint)]
+    libx11.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+
+    display = libx11.XOpenDisplay(None)
+    if not display:
+        return None, None
+
+    opcode, event, error = ctypes.c_int(), ctypes.c_int(), ctypes.c_int()
+    major, minor = ctypes.c_int(1), ctypes.c_int(0)
+
+    if not libx11.XkbQueryExtension(display, *[ctypes.byref(x) for x in [opcode, event, error, major, minor]]):
+        return None, None
+
+    return libx11, display
+
+def xkb_lock_key_state(libx11, display):
+    indicators = ctypes.c_uint()
+    libx11.XkbGetIndicatorState(display, XKB_USE_CORE_KBD, ctypes.byref(indicators))
+
+    return {
+        lock: bool(indicators.value & mask)
+        for lock, mask in LOCK_KEY_INDICATORS.items()
+    }
+
+def xset_lock_key_state():
+    try:
+        xset = run_command(['xset', 'q'], output=True)
+    except (OSError, CalledProcessError):
+        xset = ''
+
+    return {
+        'caps': bool(re.search(r'Caps Lock:\s*on', xset)),
+        'num': bool(re.search(r'Num Lock:\s*on', xset)),
+    }
+
+def watch_lock_keys():
+    libx11, display = open_xkb_display()
+
+    if libx11 is None:
+        while True:
+            set_lock_key_state(xset_lock_key_state())
+            time.sleep(LOCK_KEY_POLL_TIME)
+
+    libx11.XkbSelectEvents(
+        display, XKB_USE_CORE_KBD,
+        XKB_INDICATOR_STATE_NOTIFY_MASK, XKB_INDICATOR_STATE_NOTIFY_MASK,
     )
 
-KEYBINDINGS['96']  = lambda byte_signal: system_default_sink_volume_control(0)
-KEYBINDINGS['97']  = lambda byte_signal: system_default_sink_volume_control(1)
-KEYBINDINGS['98']  = lambda byte_signal: system_default_sink_volume_control(2)
-KEYBINDINGS['99']  = lambda byte_signal: system_default_sink_volume_control(3)
-KEYBINDINGS['100'] = lambda byte_signal: system_default_sink_volume_control(4)
-KEYBINDINGS['101'] = lambda byte_signal: system_default_sink_volume_control(5)
-KEYBINDINGS['102'] = lambda byte_signal: system_default_sink_volume_control(6)
-KEYBINDINGS['103'] = lambda byte_signal: system_default_sink_volume_control(7)
-KEYBINDINGS['104'] = lambda byte_signal: system_default_sink_volume_control(8)
+    # only indicator notifications were selected, so every event means "look again"
+    event = ctypes.create_string_buffer(XEVENT_SIZE)
+    while True:
+        set_lock_key_state(xkb_lock_key_state(libx11, display))
+        libx11.XNextEvent(display, event)
 
-KEYBINDINGS['112'] = KEYBINDINGS['96']
-KEYBINDINGS['113'] = KEYBINDINGS['97']
-KEYBINDINGS['114'] = KEYBINDINGS['98']
-KEYBINDINGS['115'] = KEYBINDINGS['99']
-KEYBINDINGS['116'] = KEYBINDINGS['100']
-KEYBINDINGS['117'] = KEYBINDINGS['101']
-KEYBINDINGS['118'] = KEYBINDINGS['102']
-KEYBINDINGS['119'] = KEYBINDINGS['103']
-KEYBINDINGS['120'] = lambda byte_signal: system_default_sink_toggle()
+def start_lock_key_watcher():
+    watcher = threading.Thread(target=watch_lock_keys, name='lock-key-watcher')
+    watcher.daemon = True
+    watcher.start()
 
 
 ################################################################
-### Light Sequences ############################################
+### System Audio State #########################################
 ################################################################
 
-def boot_sequence(update_me=True):
-    sleep_time = 0.03
-    multiplier = .98
-    pause_time = 0.5
+# kept up to date by a long-lived `pactl subscribe` child rather than by polling
+AUDIO_STATE = {
+    'sink'  : { 'volume': None, 'muted': None },
+    'source': { 'volume': None, 'muted': None },
+}
 
-    automap_signal = lambda x: [None, 104 + x, 0]
-    button_signal = lambda x: [None, floor(x/LAUNCHPAD_COLS)*16 + x%LAUNCHPAD_COLS, 0]
+AUDIO_TARGETS = {
+    'sink'  : '@DEFAULT_SINK@',
+    'source': '@DEFAULT_SOURCE@',
+}
 
-    for x in range(LAUNCHPAD_COLS - 1):
-        color_automap_button(automap_signal(x), force_default=True)
-        time.sleep(sleep_time)
-        sleep_time *= multiplier
+# per-application streams, e.g. { 12: { 'name': 'Firefox', 'volume': 100, 'muted': False } };
+# replaced as a whole, so readers should take one reference and use that
+SINK_INPUTS = {}
 
-    for x in range(LAUNCHPAD_ROWS * LAUNCHPAD_COLS):
-        color_button(byte_signal=button_signal(x), colors=BUTTON_COLORS['default'])
-        time.sleep(sleep_time)
-        sleep_time *= multiplier
+AUDIO_STATE_LISTENERS = [] # called with the kind of device whose state changed
 
-    time.sleep(pause_time)
+# Changes made from the Launchpad are shown before the audio server has them.
+# Until a read confirms one, reads which disagree with it are taken as stale
+# (e.g. an event for an earlier step of a sweep) rather than painted.
+AUDIO_EXPECTED = {} # (kind, field) or ('sink-input', index, field) -> (value, deadline)
+AUDIO_EXPECTED_LOCK = threading.Lock()
 
-    for x in range(LAUNCHPAD_COLS - 1):
-        color_automap_button(automap_signal(x))
-    for x in range(LAUNCHPAD_ROWS*LAUNCHPAD_COLS):
-        color_button(button_signal(x))
+def expect_audio_state(key, value):
+    with AUDIO_EXPECTED_LOCK:
+        AUDIO_EXPECTED[key] = (value, time.perf_counter() + AUDIO_CONFIRM_TIME)
 
-    if update_me:
-        update()
+def reconcile_audio_state(key, read):
+    # what to show for a fresh read of key
+    with AUDIO_EXPECTED_LOCK:
+        if key not in AUDIO_EXPECTED:
+            return read
 
-################################################################
-### Persistent Updates #########################################
-################################################################
+        value, deadline = AUDIO_EXPECTED[key]
 
-def update():
-    update_midi_port()
-    update_global_flash_cycle()
-    update_output_volume_visual()
-    update_input_volume_visual()
-    update_key_lock_visual()
+        if read != value and time.perf_counter() < deadline:
+            count('stale_audio_reads_total')
+            return value
+
+        del AUDIO_EXPECTED[key]
+        return read
+
+def overdue_audio_kinds():
+    # kinds with a change no read has confirmed in time; they are given up on
+    # here, and one fresh read of each puts the audio server's word back
+    now = time.perf_counter()
+    with AUDIO_EXPECTED_LOCK:
+        overdue = [key for key, (_, deadline) in AUDIO_EXPECTED.items() if now >= deadline]
+        for key in overdue:
+            del AUDIO_EXPECTED[key]
+
+    return {key[0] for key in overdue}
 
-def update_global_flash_cycle():
+def forget_audio_streams(indices):
+    # expectations for streams which have gone away can never be confirmed
+    with AUDIO_EXPECTED_LOCK:
+        for key in list(AUDIO_EXPECTED):
+            if key[0] == 'sink-input' and key[1] not in indices:
+                del AUDIO_EXPECTED[key]
+
+def show_audio_state(kind, field, value):
+    expect_audio_state((kind, field), value)
+    AUDIO_STATE[kind][field] = value
+
+def show_application_state(index, field, value):
+    expect_audio_state(('sink-input', index, field), value)
+
+    inputs = SINK_INPUTS
+    if index in inputs:
+        inputs[index][field] = value
+
+def pactl_output(*args):
+    try:
+        return run_command(['pactl'] + list(args), output=True)
+    except (OSError, CalledProcessError):
+        return ''
+
+def query_audio_state(kind):
+    target = AUDIO_TARGETS[kind]
+
+    volume = re.search(r'(\d+)%', pactl_output('get-{0}-volume'.format(kind), target))
+    muted = pactl_output('get-{0}-mute'.format(kind), target)
+
+    return {
+        'volume': int(volume.group(1)) if volume else None,
+        'muted': 'yes' in muted if muted else None,
+    }
+
+def refresh_audio_state(kind):
+    state = query_audio_state(kind)
+
+    for field in state:
+        state[field] = reconcile_audio_state((kind, field), state[field])
+
+    if state == AUDIO_STATE[kind]:
+        return
+
+    AUDIO_STATE[kind].update(state)
+
+    for listener in AUDIO_STATE_LISTENERS:
+        listener(kind)
+
+def query_sink_inputs():
+    inputs = {}
+    index = None
+
+    for line in pactl_output('list', 'sink-inputs').splitlines():
+        line = line.strip()
+
+        header = re.match(r'Sink Input #(\d+)', line)
+        if header:
+            index = int(header.group(1))
+            inputs[index] = { 'name': '#{0}'.format(index), 'volume': None, 'muted': None }
+        elif index is None:
+            continue
+        elif line.startswith('Mute:'):
+            inputs[index]['muted'] = 'yes' in line
+        elif line.startswith('Volume:'):
+            volume = re.search(r'(\d+)%', line)
+            inputs[index]['volume'] = int(volume.group(1)) if volume else None
+        elif line.startswith('application.name ='):
+            inputs[index]['name'] = line.split('=', 1)[1].strip().strip('"')
+
+    return inputs
+
+def refresh_sink_inputs():
     # pylint: disable=global-statement
-    global GLOBAL_FLASH_CYCLE, GLOBAL_FLASH_ON,\
-           APPLICATION_REFRESH_TIME, GLOBAL_FLASH_TIME
+    global SINK_INPUTS
 
-    GLOBAL_FLASH_CYCLE -= APPLICATION_REFRESH_TIME
+    inputs = query_sink_inputs()
+    forget_audio_streams(inputs)
 
-    if GLOBAL_FLASH_CYCLE < 0:
-        GLOBAL_FLASH_ON = not GLOBAL_FLASH_ON
-        GLOBAL_FLASH_CYCLE = GLOBAL_FLASH_TIME
+    for index, stream in inputs.items():
+        for field in ['volume', 'muted']:
+            stream[field] = reconcile_audio_state(('sink-input', index, field), stream[field])
 
+    if inputs == SINK_INPUTS:
+        return
 
-def update_output_volume_visual():
-    cmd = 'amixer -D pulse sget Master | grep "Front Left:" | sed "s/^.*\\[\\(.*\\)%.*$/\\1/" || return 0'
-    volume = os.popen(cmd).read()
-    if volume:
-        volume = int(volume)
-        level = floor(
-            round(volume / MAX_OUTPUT_VOLUME * MAX_OUTPUT_LEVEL)
-        )
+    SINK_INPUTS = inputs
+
+    for listener in AUDIO_STATE_LISTENERS:
+        listener('sink-input')
+
+def refresh_audio(kind):
+    if kind == 'sink-input':
+        refresh_sink_inputs()
+    else:
+        refresh_audio_state(kind)
+
+def audio_event_kinds(line):
+    # e.g. "Event 'change' on sink #0"; the default device may change on 'server'
+    if " on sink-input #" in line:
+        return ['sink-input']
+    if " on sink #" in line:
+        return ['sink']
+    if " on source #" in line:
+        return ['source']
+    if " on server" in line:
+        return ['sink', 'source']
+    return []
+
+def watch_audio_events():
+    while True:
+        try:
+            subscriber = spawn_command(['pactl', 'subscribe'], stdout=PIPE, universal_newlines=True)
+        except OSError:
+            time.sleep(AUDIO_RECONNECT_TIME)
+            continue
+
+        for kind in list(AUDIO_STATE) + ['sink-input']:
+            refresh_audio(kind)
+
+        for line in subscriber.stdout:
+            for kind in audio_event_kinds(line):
+                refresh_audio(kind)
+
+        # the audio server went away (e.g. `pulseaudio -k`); wait for it to return
+        subscriber.wait()
+        time.sleep(AUDIO_RECONNECT_TIME)
+
+def start_audio_watcher():
+    watcher = threading.Thread(target=watch_audio_events, name='audio-watcher')
+    watcher.daemon = True
+    watcher.start()
+
+
+# --------------------------------------------------------------
+# Audio control channel
+# --------------------------------------------------------------
 
-        system_default_sink_volume_control(level, set_volume=False)
-        system_default_sink_toggle(toggle=False)
+PULSE_VOLUME_NORM = 65536 # 100%
 
-def update_input_volume_visual():
-    cmd = 'amixer -D pulse sget Capture | grep "Front Left:" | sed "s/^.*\\[\\(.*\\)%.*$/\\1/" || return 0'
-    volume = os.popen(cmd).read()
-    if volume:
-        volume = int(volume)
-        level = floor(
-            round(volume / MAX_INPUT_VOLUME * MAX_INPUT_LEVEL)
+AUDIO_CONTROL = None # one long-lived `pacmd` shell, fed commands over stdin
+AUDIO_CONTROL_LOCK = threading.Lock()
+AUDIO_CONTROL_RETRY = 0.0 # when pacmd may be tried again; None once it cannot work here
+
+def open_audio_control():
+    # the pacmd shell; None if pacmd cannot work here at all, and OSError if
+    # it might once the audio server is back (e.g. while `pulseaudio -k` restarts it)
+    try:
+        control = spawn_command(
+            ['pacmd'],
+            stdin=PIPE, stdout=PIPE, stderr=DEVNULL,
+            universal_newlines=True,
         )
+    except FileNotFoundError:
+        return None
 
-        pulse_default_source_volume_control(level, set_volume=False)
-        pulse_default_source_toggle(toggle=False)
+    # a working pacmd greets us first; one without a daemon exits at once
+    ready, _, _ = select.select([control.stdout], [], [], AUDIO_CONTROL_GREETING_TIME)
+    if not ready or not control.stdout.readline():
+        control.kill()
+        control.wait()
 
-def update_key_lock_visual():
-    update_num_lock_visual()
-    update_caps_lock_visual()
+        # pacmd is usually installed even where the server is not PulseAudio
+        # itself (e.g. pipewire-pulse), and there it never works
+        if audio_server_name() not in (None, 'pulseaudio'):
+            return None
+        raise OSError('pacmd did not answer')
+
+    # its replies are never looked at, but must not fill up the pipe
+    drain = threading.Thread(target=drain_output, args=(control.stdout,), name='pacmd-output')
+    drain.daemon = True
+    drain.start()
+
+    return control
+
+def audio_server_name():
+    try:
+        info = run_command(['pactl', 'info'], output=True)
+    except (OSError, CalledProcessError):
+        return None # no server to ask right now
 
-def update_num_lock_visual():
-    color_automap_button(generate_fake_midi_signal(note=104, on=num_lock()))
+    name = re.search(r'^Server Name: (.*)$', info, re.MULTILINE)
+    return name and name.group(1).strip()
 
-def update_caps_lock_visual():
-    color_automap_button(generate_fake_midi_signal(note=105, on=caps_lock()))
+def drain_output(stream):
+    while stream.readline():
+        pass
 
-def update_midi_port():
+def audio_command(*args):
     # pylint: disable=global-statement
-    global GLOBAL_REFRESH_PORT_SIGNAL, PORT_COUNT
+    global AUDIO_CONTROL, AUDIO_CONTROL_RETRY
+
+    args = [str(arg) for arg in args]
+
+    with AUDIO_CONTROL_LOCK:
+        for _ in range(2):
+            if AUDIO_CONTROL is None or AUDIO_CONTROL.poll() is not None:
+                AUDIO_CONTROL = None
+
+                if AUDIO_CONTROL_RETRY is None or time.perf_counter() < AUDIO_CONTROL_RETRY:
+                    break
+
+                try:
+                    AUDIO_CONTROL = open_audio_control()
+                except OSError:
+                    # pactl for now; pacmd again once the server has had time to return
+                    AUDIO_CONTROL_RETRY = time.perf_counter() + AUDIO_CONTROL_RETRY_TIME
+                    break
+
+                if AUDIO_CONTROL is None:
+                    AUDIO_CONTROL_RETRY = None
+                    break
+
+            try:
+                with timed('subprocess_seconds', (('command', 'pacmd'),)):
+                    AUDIO_CONTROL.stdin.write(' '.join(args) + '\n')
+                    AUDIO_CONTROL.stdin.flush()
+                return
+            except (OSError, ValueError):
+                # the audio server restarted underneath pacmd; start a fresh one
+                AUDIO_CONTROL = None
+
+    # no pacmd, one without a PulseAudio daemon to talk to (e.g. pipewire), or
+    # one waiting to be retried; pactl understands the same commands
+    run_command(['pactl'] + args)
+
+def set_audio_volume(kind, volume):
+    show_audio_state(kind, 'volume', volume)
+    audio_command(
+        'set-{0}-volume'.format(kind),
+        AUDIO_TARGETS[kind],
+        int(PULSE_VOLUME_NORM * volume / 100),
+    )
+
+def set_audio_mute(kind, muted):
+    show_audio_state(kind, 'muted', muted)
+    audio_command(
+        'set-{0}-mute'.format(kind),
+        AUDIO_TARGETS[kind],
+        'yes' if muted else 'no',
+    )
+
+def set_application_volume(index, volume):
+    show_application_state(index, 'volume', volume)
+    audio_command('set-sink-input-volume', index, int(PULSE_VOLUME_NORM * volume / 100))
+
+def set_application_mute(index, muted):
+    show_application_state(index, 'muted', muted)
+    audio_command('set-sink-input-mute', index, 'yes' if muted else 'no')
+
+
+################################################################
+### System Load ################################################
+################################################################
+
+# /proc is read through descriptors opened once, from offset 0 each time, and
+# only as far as the parser needs; no tools are run.
+PROC_READ_SIZE = 4096
+
+# sources a "monitors" row can show: cpu (all cores), cpu0, cpu1..., memory, disk, network
+MONITOR_SOURCE = re.compile(r'^(cpu\d*|memory|disk|network)$')
+
+# which block devices count towards disk load (not loop devices or ramdisks)
+MONITOR_DISK = re.compile(rb'^(?!loop|ram|zram)')
 
-    current_port_count = midiout.get_port_count()
+class ProcFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
 
-    if current_port_count < PORT_COUNT:
-        PORT_COUNT = midiout.get_port_count()
+    def lines(self):
+        # nothing when the file cannot be opened (e.g. not on Linux)
+        if self.fd is None:
+            try:
+                self.fd = os.open(self.path, os.O_RDONLY)
+            except OSError:
+                return
 
-    elif current_port_count > PORT_COUNT:
-        activate_ports()
-        boot_sequence(update_me=False)
+        offset, rest = 0, b''
 
-def activate_ports():
+        while True:
+            chunk = os.pread(self.fd, PROC_READ_SIZE, offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            yield from lines
+
+        if rest:
+            yield rest
+
+class SystemLoad(object):
+    # fractions of capacity in use, from the counters' change between samples
+    def __init__(self):
+        self.stat = ProcFile('/proc/stat')
+        self.meminfo = ProcFile('/proc/meminfo')
+        self.diskstats = ProcFile('/proc/diskstats')
+        self.netdev = ProcFile('/proc/net/dev')
+
+        self.counters = {} # source -> counters at the last sample
+        self.stamp = None
+
+    def sample(self):
+        now = time.perf_counter()
+        elapsed, self.stamp = (now - self.stamp if self.stamp else None), now
+
+        previous, self.counters = self.counters, self.read_counters()
+        loads = {}
+
+        if elapsed:
+            for source, counter in self.counters.items():
+                if source not in previous:
+                    continue
+
+                if source.startswith('cpu'):
+                    busy = counter[0] - previous[source][0]
+                    total = counter[1] - previous[source][1]
+                    loads[source] = busy / total if total else 0
+                elif source.startswith('disk-'):
+                    # the busiest device; its counter is milliseconds spent doing I/O
+                    busy = (counter - previous[source]) / 1000 / elapsed
+                    loads['disk'] = max(loads.get('disk', 0), busy)
+                else:
+                    loads[source] = (counter - previous[source]) / elapsed / MONITOR_NETWORK_MAX
+
+        memory = {}
+        for line in self.meminfo.lines():
+            name, _, value = line.partition(b':')
+            if name in (b'MemTotal', b'MemAvailable'):
+                memory[name] = int(value.split()[0])
+
+            if len(memory) == 2:
+                loads['memory'] = 1 - memory[b'MemAvailable'] / memory[b'MemTotal']
+                break
+
+        return loads
+
+    def read_counters(self):
+        counters = {}
+
+        for line in self.stat.lines():
+            if not line.startswith(b'cpu'):
+                break # the cpu lines come first
+
+            fields = line.split()
+            times = [int(field) for field in fields[1:9]]
+            # (busy, total); idle and iowait are the 4th and 5th
+            counters[fields[0].decode()] = (sum(times) - times[3] - times[4], sum(times))
+
+        for line in self.diskstats.lines():
+            fields = line.split()
+            if len(fields) > 12 and MONITOR_DISK.match(fields[2]):
+                counters['disk-' + fields[2].decode()] = int(fields[12])
+
+        network = 0
+        for line in self.netdev.lines():
+            interface, _, fields = line.partition(b':')
+            fields = fields.split()
+            if len(fields) > 8 and interface.strip() != b'lo':
+                network += int(fields[0]) + int(fields[8]) # bytes received and sent
+        counters['network'] = network
+
+        return counters
+
+SYSTEM_LOAD = {} # source -> fraction in use; replaced as a whole on every sample
+
+def watch_system_load():
     # pylint: disable=global-statement
-    global PORT_COUNT
+    global SYSTEM_LOAD
 
-    midiout.close_port()
-    midiin.close_port()
+    load = SystemLoad()
 
-    time.sleep(2.0)
+    while True:
+        if any(page.layout.monitors is not None for device in DEVICES for page in device.pages):
+            with timed('monitor_sample_seconds'):
+                SYSTEM_LOAD = load.sample()
 
-    cmd = '''amidi --list-devices | grep Launchpad -n | sed 's/:.*$//'; '''
-    cmd_output = os.popen(cmd).read()
-    port_number = int(cmd_output) - 1 # @TODO : Figure out why the offset changes
+            for device in DEVICES:
+                changed = [update_monitors_visual(view) for view in device.views()]
+                if any(changed):
+                    flush_leds(device)
 
-    midiout.open_port(port_number)
-    midiin.open_port(port_number)
+        time.sleep(MONITOR_TIME)
 
-    PORT_COUNT = midiout.get_port_count()
+def start_system_load_watcher():
+    watcher = threading.Thread(target=watch_system_load, name='system-load-watcher')
+    watcher.daemon = True
+    watcher.start()
 
-    midiin.set_callback(input_callback)
-    midiout.send_message(RESET_LIGHT_SIGNAL)
 
 ################################################################
-### Application Loop ###########################################
+### Keybound Actions ###########################################
 ################################################################
 
-def input_callback(midi_in, dump):
-    # @TODO: remove debug print
-    if dump is not None:
-        print(dump)
+def key_action(key, automap=False):
+    def action(device, byte_signal):
+        if automap:
+            color_automap_button(device, byte_signal)
+        bind_key(device, byte_signal, key)
+    return action
 
-    byte_signal = midi_in[0]
-    note = byte_signal[1]
+def toggle_num_lock(_device, byte_signal):
+    if is_keydown(byte_signal):
+        num_lock(toggle=True)
+        repaint_lock_key_visual(['num'])
 
-    is_automap = is_automap_key(byte_signal)
-    is_keybinding = not is_automap and str(note) in KEYBINDINGS.keys()
-    is_holdbinding = not is_automap and str(note) in HOLD_BINDINGS.keys()
-    is_automap_binding = is_automap and str(note) in AUTOMAP.keys()
+def toggle_caps_lock(_device, byte_signal):
+    if is_keydown(byte_signal):
+        caps_lock(toggle=True)
+        repaint_lock_key_visual(['caps'])
+
+def restart_audio_engine(device, byte_signal):
+    restart_pulse_audio()
+    color_automap_button(device, byte_signal)
+
+# name -> (builder, lane, mode). A builder takes the layout entry and whether
+# it sits on the automap row, and returns the handler for it. 'hold' handlers
+# see both press and release, 'keydown' handlers only the press.
+ACTIONS = {
+    'color': (
+        lambda spec, automap: color_automap_button if automap else color_button,
+        'default', 'hold',
+    ),
+    'key': (
+        lambda spec, automap: key_action(spec['key'], automap),
+        'keyboard', 'hold',
+    ),
+    'num-lock': (
+        lambda spec, automap: toggle_num_lock,
+        'keyboard', 'hold',
+    ),
+    'caps-lock': (
+        lambda spec, automap: toggle_caps_lock,
+        'keyboard', 'hold',
+    ),
+    'restart-audio': (
+        lambda spec, automap: restart_audio_engine,
+        'audio-engine', 'hold',
+    ),
+    'previous-page': (
+        lambda spec, automap: page_action(-1),
+        'pages', 'hold',
+    ),
+    'next-page': (
+        lambda spec, automap: page_action(1),
+        'pages', 'hold',
+    ),
+    'macro': (
+        lambda spec, automap: macro_action(spec),
+        'keyboard', 'keydown',
+    ),
+}
+
+ACTION_PARAMETERS = { 'key': ['key'], 'macro': ['steps'] }
+AUTOMAP_ONLY_ACTIONS = ['num-lock', 'caps-lock', 'restart-audio', 'previous-page', 'next-page']
+
+
+# --------------------------------------------------------------
+# Pages
+# --------------------------------------------------------------
+
+def show_page(device, number):
+    # the frame is asked for before the writer can see the new page, so the
+    # page's differences never go out LED by LED ahead of it
+    with LED_LOCK:
+        device.select(number)
 
-    print(byte_signal)
-    print('input callback')
+        # hidden pages are kept painted, so switching is a single frame send
+        send_frame(device)
 
-    if is_keybinding:
+def page_action(step):
+    def action(device, byte_signal):
         if is_keydown(byte_signal):
-            KEYBINDINGS[str(note)](byte_signal)
+            show_page(device, device.page + step)
+        color_automap_button(device, byte_signal)
+    return action
 
-    elif is_holdbinding:
-        HOLD_BINDINGS[str(note)](byte_signal)
 
-    elif is_automap:
-        key = str(note) if is_automap_binding else 'default'
-        AUTOMAP[key](byte_signal=byte_signal)
+# --------------------------------------------------------------
+# Volume bars
+# --------------------------------------------------------------
+
+def audio_volume_control(device, kind, level):
+    bar = device.layout.bars[kind]
+    level = fix_value_to_bounds(level, 0, bar['max-level'])
+    paint_leds(device, bar['frames'][level])
+    device.levels[kind] = level
 
-    else:
-        color_button(byte_signal=byte_signal)
-        print(note)
+def audio_level_preview(device, kind, level):
+    # the level is shown, and taken as the state, before the command has run
+    audio_volume_control(device, kind, level)
+    show_audio_state(kind, 'volume', bar_volume(device, kind, level))
 
+def audio_mute_toggle(device, kind, toggle=True):
+    is_muted = bool(AUDIO_STATE[kind]['muted'])
 
-if __name__ == '__main__':
-    # pylint: disable=no-member
-    midiout = rtmidi.MidiOut()
-    midiin = rtmidi.MidiIn()
+    if toggle:
+        # as a preview: send_audio_mute tells the audio server afterwards
+        is_muted = not is_muted
+        show_audio_state(kind, 'muted', is_muted)
 
-    activate_ports()
-    boot_sequence()
+    bar = device.layout.bars[kind]
+    color_button(
+        device,
+        generate_fake_midi_signal(note=bar['toggle'], on=not is_muted),
+        colors=bar['colors']['toggle'],
+    )
 
-    try:
-        while True:
-            update()
-            time.sleep(APPLICATION_REFRESH_TIME)
-    except KeyboardInterrupt:
-        midiout.send_message(RESET_LIGHT_SIGNAL)
-        del midiin, midiout
+def send_audio_mute(device, kind):
+    set_audio_mute(kind, bool(AUDIO_STATE[kind]['muted']))
+    repaint_audio_visual(kind, skip=device)
+
+def set_audio_level(device, kind, level):
+    set_audio_volume(kind, bar_volume(device, kind, level))
+
+    # the pressed device already previewed the level; the others follow here
+    repaint_audio_visual(kind, skip=device)
+
+def bar_volume(device, kind, level):
+    bar = device.layout.bars[kind]
+    return floor(bar['max-volume'] * level/bar['max-level'])
+
+def volume_level(device, kind):
+    bar = device.layout.bars[kind]
+    return floor(round(AUDIO_STATE[kind]['volume'] / bar['max-volume'] * bar['max-level']))
+
+
+# --------------------------------------------------------------
+# Application volume
+# --------------------------------------------------------------
+
+# each grid row of an "applications" page is one application's volume bar,
+# with its mute toggle in the scene column
+APPLICATION_MAX_LEVEL = LAUNCHPAD_COLS - 2
+APPLICATION_TOGGLE_COL = LAUNCHPAD_COLS - 1
+
+def application_at(row, inputs=None):
+    inputs = SINK_INPUTS if inputs is None else inputs
+    indices = sorted(inputs)
+    return indices[row] if row < len(indices) else None
+
+def application_volume_control(device, row, level):
+    if application_at(row) is not None:
+        paint_leds(device, device.layout.applications['frames'][row][level])
+
+def application_level_preview(device, row, level):
+    index = application_at(row)
+    if index is None:
+        return
+
+    application_volume_control(device, row, level)
+    show_application_state(index, 'volume', application_volume(device, level))
+
+def application_mute_toggle(device, row, toggle=True):
+    inputs = SINK_INPUTS
+    index = application_at(row, inputs)
+    if index is None:
+        return
+
+    is_muted = bool(inputs[index]['muted'])
+
+    if toggle:
+        is_muted = not is_muted
+        show_application_state(index, 'muted', is_muted)
+
+    color_button(
+        device,
+        generate_fake_midi_signal(note=row * 16 + APPLICATION_TOGGLE_COL, on=not is_muted),
+        colors=device.layout.applications['colors']['toggle'],
+    )
+
+def send_application_mute(device, row):
+    inputs = SINK_INPUTS
+    index = application_at(row, inputs)
+    if index is None:
+        return
+
+    set_application_mute(index, bool(inputs[index]['muted']))
+    repaint_audio_visual('sink-input', skip=device)
+
+def set_application_level(device, row, level):
+    index = application_at(row)
+    if index is None:
+        return
+
+    set_application_volume(index, application_volume(device, level))
+    repaint_audio_visual('sink-input', skip=device)
+
+def application_volume(device, level):
+    return floor(device.layout.applications['max-volume'] * level / APPLICATION_MAX_LEVEL)
+
+def update_applications_visual(device):
+    applications = device.layout.applications
+    if applications is None:
+        return
+
+    inputs = SINK_INPUTS
+
+    for row in range(LAUNCHPAD_ROWS):
+        index = application_at(row, inputs)
+
+        if index is None or inputs[index]['volume'] is None:
+            paint_leds(device, applications['empty'][row])
+            continue
+
+        level = round(inputs[index]['volume'] / applications['max-volume'] * APPLICATION_MAX_LEVEL)
+        application_volume_control(device, row, fix_value_to_bounds(level, 0, APPLICATION_MAX_LEVEL))
+        application_mute_toggle(device, row, toggle=False)
+
+
+# --------------------------------------------------------------
+# System load
+# --------------------------------------------------------------
+
+# each grid row of a "monitors" page is a bar graph of one load source
+MONITOR_MAX_LEVEL = LAUNCHPAD_COLS - 1
+
+def update_monitors_visual(device, force=False):
+    # True when a row changed; rows are only repainted when their level does
+    monitors = device.layout.monitors
+    if monitors is None:
+        return False
+
+    loads = SYSTEM_LOAD
+    changed = False
+
+    for row, source in enumerate(monitors['rows']):
+        load = loads.get(source, 0)
+        level = fix_value_to_bounds(round(load * MONITOR_MAX_LEVEL), 0, MONITOR_MAX_LEVEL)
+
+        if force or device.levels.get(('monitor', row)) != level:
+            paint_leds(device, monitors['frames'][row][level])
+            device.levels[('monitor', row)] = level
+            changed = True
+
+    return changed
+
+
+# --------------------------------------------------------------
+# Macros
+# --------------------------------------------------------------
+
+# A macro is a list of steps: {"keys": "ctrl+shift+t"} presses a chord,
+# {"text": "hello"} types, {"audio": "sink", "volume": 50, "mute": "toggle"}
+# changes a volume bar's device and {"delay": 0.25} waits. Steps between two
+# delays run as one job on the pad's lane; each delay is a timer on the wheel,
+# so macros overlap freely and pressing a running macro's pad again stops it.
+MACRO_MODIFIERS = {
+    'ctrl': 'Control_L',
+    'shift': 'Shift_L',
+    'alt': 'Alt_L',
+    'super': 'Super_L',
+}
+
+RUNNING_MACROS = {} # (page, status, note) -> Macro
+
+def chord_step(step):
+    keys = [MACRO_MODIFIERS.get(key, key) for key in step['keys'].split('+')]
+
+    def run():
+        for key in keys:
+            keydown(key)
+        for key in reversed(keys):
+            keyup(key)
+    return run
+
+def text_step(step):
+    return lambda: type_text(step['text'])
+
+def audio_step(step):
+    kind = step['audio']
+
+    def run():
+        if 'volume' in step:
+            set_audio_volume(kind, step['volume'])
+
+        if 'mute' in step:
+            muted = not AUDIO_STATE[kind]['muted'] if step['mute'] == 'toggle' else step['mute']
+            set_audio_mute(kind, muted)
+
+        repaint_audio_visual(kind)
+    return run
+
+MACRO_STEPS = {
+    'keys': chord_step,
+    'text': text_step,
+    'audio': audio_step,
+}
+
+def compile_macro(steps):
+    # [jobs, delay after them], with no delay between the jobs of one segment
+    segments = [[[], 0]]
+
+    for step in steps:
+        if 'delay' in step:
+            segments[-1][1] += step['delay']
+            continue
+
+        if segments[-1][1]:
+            segments.append([[], 0])
+
+        kind = next(kind for kind in MACRO_STEPS if kind in step)
+        segments[-1][0].append(MACRO_STEPS[kind](step))
+
+    return segments
+
+class Macro(object):
+    # one run of a macro on one pad
+    def __init__(self, segments, lane, device, byte_signal):
+        self.segments = segments
+        self.lane = lane
+        self.device = device
+        self.byte_signal = byte_signal
+
+        self.page = device.pages[device.page]
+        self.key = (self.page, byte_signal[0], byte_signal[1])
+        self.timer = None
+        self.cancelled = False
+
+    def run(self, number=0):
+        if self.cancelled:
+            return
+
+        jobs, delay = self.segments[number]
+        for job in jobs:
+            job()
+
+        if number + 1 == len(self.segments):
+            self.finish()
+            return
+
+        # the rest runs on the pad's lane again, after the delay
+        resume = lambda device, byte_signal: self.run(number + 1)
+        self.timer = TIMERS.schedule(delay, lambda: self.lane.submit(resume, self.device, self.byte_signal))
+
+    def cancel(self):
+        self.cancelled = True
+        if self.timer is not None:
+            self.timer.cancel()
+        self.finish()
+
+    def finish(self):
+        if RUNNING_MACROS.get(self.key) is self:
+            del RUNNING_MACROS[self.key]
+
+        # the pad stays lit while its macro runs, on whichever page started it
+        view = self.device if self.device.pages[self.device.page] is self.page else self.page
+        released = [self.byte_signal[0], self.byte_signal[1], 0]
+
+        color_pad(view, released)
+
+def macro_action(spec):
+    segments = compile_macro(spec['steps'])
+    lane = action_lane(spec.get('lane', 'keyboard'))
+
+    def action(device, byte_signal):
+        if not is_keydown(byte_signal):
+            return
+
+        running = RUNNING_MACROS.get((device.pages[device.page], byte_signal[0], byte_signal[1]))
+        if running is not None:
+            running.cancel()
+            return
+
+        macro = Macro(segments, lane, device, byte_signal)
+        RUNNING_MACROS[macro.key] = macro
+
+        color_pad(device, byte_signal)
+
+        macro.run()
+    return action
+
+
+################################################################
+### Layout #####################################################
+################################################################
+
+# Bindings, colors and the volume bars are described by a JSON (or TOML)
+# layout file, which is validated and compiled into flat, note-indexed
+# tables once; the input path only ever reads those tables.
+
+MIDI_NOTE_COUNT = 128
+
+GRID_LED_INDEX = [grid_led_index(note) for note in range(MIDI_NOTE_COUNT)]
+AUTOMAP_LED_INDEX = [
+    automap_led_index(note) if 0 <= note - AUTOMAP_FIRST_NOTE < AUTOMAP_LED_COUNT else None
+    for note in range(MIDI_NOTE_COUNT)
+]
+
+NO_ACTION = (None, None, None, None, False)
+
+class LayoutError(ValueError):
+    pass
+
+class Layout(object):
+    # everything the driver needs from one page of a layout file, precomputed
+    def __init__(self, spec):
+        self.flash = frozenset(spec.get('flash', []))
+
+        keys = spec.get('keys', {})
+        automap = spec.get('automap', {})
+
+        self.default_colors = keys['default']['colors']
+        self.automap_default_colors = automap['default']['colors']
+
+        self.note_velocities = compile_velocities(keys, self.flash)
+        self.automap_velocities = compile_velocities(automap, self.flash)
+        self.automap_default_velocities = compile_velocities({ 'default': automap['default'] }, self.flash)
+
+        self.bars = {}
+        for kind, bar in spec.get('bars', {}).items():
+            self.bars[kind] = dict(bar)
+            self.bars[kind]['max-level'] = bar['main'][1] - bar['main'][0]
+            self.bars[kind]['frames'] = compile_volume_bar(bar, self.flash)
+
+        self.applications = None
+        if 'applications' in spec:
+            self.applications = dict(spec['applications'])
+            self.applications['frames'], self.applications['empty'] = compile_application_rows(
+                spec['applications'], self.flash,
+            )
+
+        self.monitors = None
+        if 'monitors' in spec:
+            self.monitors = dict(spec['monitors'])
+            self.monitors['frames'] = compile_monitor_rows(spec['monitors'], self.flash)
+
+        self.lock_key_notes = {
+            lock: [int(note) for note, entry in automap.items() if entry.get('action') == lock + '-lock']
+            for lock in LOCK_KEY_STATE
+        }
+
+        self.note_actions = compile_actions(
+            keys, self.bars, automap=False, applications=self.applications, monitors=self.monitors,
+        )
+        self.automap_actions = compile_actions(automap, {}, automap=True)
+
+        self.note_gestures = compile_gestures(keys, automap=False, chords=spec.get('chords', []))
+        self.automap_gestures = compile_gestures(automap, automap=True)
+
+
+def button_velocity(note, color, active, flashing=()):
+    velocity = COLORS[color]
+
+    if active and note in flashing:
+        velocity = velocity & ~BOTH_BUFFERS | FLASH_BUFFERS
+
+    return velocity
+
+def compile_velocities(entries, flashing):
+    # [inactive velocities, active velocities], each indexed by note
+    colors_for = lambda note: entries.get(str(note), entries['default']).get(
+        'colors', entries['default']['colors']
+    )
+
+    return [
+        [
+            button_velocity(note, colors_for(note)[0 if active else 1], active, flashing)
+            for note in range(MIDI_NOTE_COUNT)
+        ]
+        for active in [False, True]
+    ]
+
+def compile_volume_bar(bar, flashing):
+    # one ready-made list of (led index, velocity) per level of the bar
+    frames = []
+    colors = bar['colors']
+    max_level = bar['main'][1] - bar['main'][0]
+
+    for level in range(max_level + 1):
+        leds = []
+
+        for x in range(level + 1):
+            main_index = bar['main'][0] + x
+            staggered_index = fix_value_to_bounds(
+                bar['staggered'][0] + x - 1,
+                bar['staggered'][0],
+                bar['staggered'][1],
+            )
+
+            color = colors['levels'][x] if level > 0 else colors['no-volume']
+
+            for note in [main_index, staggered_index]:
+                leds.append((GRID_LED_INDEX[note], button_velocity(note, color, True, flashing)))
+
+        for x in range(max_level - level):
+            main_index = bar['main'][1] - x
+            staggered_index = fix_value_to_bounds(
+                bar['staggered'][1] - x,
+                bar['staggered'][0] + 1,
+                bar['staggered'][1],
+            )
+
+            for note in [main_index, staggered_index]:
+                leds.append((GRID_LED_INDEX[note], button_velocity(note, colors['default'], False, flashing)))
+
+        frames.append(leds)
+
+    return frames
+
+def compile_bar_actions(kind, bar):
+    # note -> action tuple for every key of a volume bar and its mute toggle
+    actions = {}
+    lane = action_lane(kind)
+
+    for first, last in [bar['main'], bar['staggered']]:
+        for note in range(first, last + 1):
+            level = note - first
+
+            # a sweep only needs its last level set, but every level it passes is painted
+            actions[note] = (
+                lane,
+                lambda device, byte_signal, level=level: set_audio_level(device, kind, level),
+                kind + '-volume',
+                lambda device, byte_signal, level=level: audio_level_preview(device, kind, level),
+                True,
+            )
+
+    actions[bar['toggle']] = (
+        lane,
+        lambda device, byte_signal: send_audio_mute(device, kind),
+        kind + '-mute',
+        lambda device, byte_signal: audio_mute_toggle(device, kind),
+        True,
+    )
+
+    return actions
+
+def compile_application_rows(applications, flashing):
+    # like a volume bar: per row, one ready-made list of (led index, velocity) per level
+    colors = applications['colors']
+    frames, empty = [], []
+
+    def color(level, col):
+        if col > level:
+            return colors['default']
+        return colors['levels'][col] if level > 0 else colors['no-volume']
+
+    for row in range(LAUNCHPAD_ROWS):
+        notes = [row * 16 + col for col in range(APPLICATION_MAX_LEVEL + 1)]
+
+        frames.append([
+            [
+                (GRID_LED_INDEX[note], button_velocity(note, color(level, col), col <= level, flashing))
+                for col, note in enumerate(notes)
+            ]
+            for level in range(APPLICATION_MAX_LEVEL + 1)
+        ])
+
+        empty.append([
+            (GRID_LED_INDEX[note], button_velocity(note, colors['empty'], False, flashing))
+            for note in notes + [row * 16 + APPLICATION_TOGGLE_COL]
+        ])
+
+    return frames, empty
+
+def compile_monitor_rows(monitors, flashing):
+    # per row, one ready-made list of (led index, velocity) per level
+    colors = monitors['colors']
+    frames = []
+
+    for row in range(len(monitors['rows'])):
+        notes = [row * 16 + col for col in range(MONITOR_MAX_LEVEL)]
+
+        frames.append([
+            [
+                (GRID_LED_INDEX[note], button_velocity(
+                    note, colors['levels'][col] if col < level else colors['default'], col < level, flashing,
+                ))
+                for col, note in enumerate(notes)
+            ]
+            for level in range(MONITOR_MAX_LEVEL + 1)
+        ])
+
+    return frames
+
+def compile_application_actions():
+    actions = {}
+    lane = action_lane('applications')
+
+    for row in range(LAUNCHPAD_ROWS):
+        for level in range(APPLICATION_MAX_LEVEL + 1):
+            actions[row * 16 + level] = (
+                lane,
+                lambda device, byte_signal, row=row, level=level: set_application_level(device, row, level),
+                'application-{0}'.format(row),
+                lambda device, byte_signal, row=row, level=level: application_level_preview(device, row, level),
+                True,
+            )
+
+        actions[row * 16 + APPLICATION_TOGGLE_COL] = (
+            lane,
+            lambda device, byte_signal, row=row: send_application_mute(device, row),
+            'application-mute-{0}'.format(row),
+            lambda device, byte_signal, row=row: application_mute_toggle(device, row),
+            True,
+        )
+
+    return actions
+
+def compile_actions(entries, bars, automap, applications=None, monitors=None):
+    actions = [NO_ACTION] * MIDI_NOTE_COUNT
+
+    for note in range(MIDI_NOTE_COUNT):
+        spec = entries.get(str(note), entries['default'])
+        build, lane, mode = ACTIONS[spec.get('action', 'color')]
+
+        actions[note] = (
+            action_lane(spec.get('lane', lane)),
+            build(spec, automap), None, None,
+            spec.get('on', mode) == 'keydown',
+        )
+
+    for kind, bar in bars.items():
+        for note, action in compile_bar_actions(kind, bar).items():
+            actions[note] = action
+
+    if applications is not None:
+        for note, action in compile_application_actions().items():
+            actions[note] = action
+
+    if monitors is not None:
+        # a key press would paint over the graph until its level next changes
+        for row in range(len(monitors['rows'])):
+            for col in range(MONITOR_MAX_LEVEL):
+                actions[row * 16 + col] = NO_ACTION
+
+    return actions
+
+class Gestures(object):
+    # what one note does besides being pressed: each is (lane, action) or None
+    def __init__(self):
+        self.long_press = None
+        self.double_tap = None
+        self.chords = [] # (notes, (lane, action)) for every chord the note is part of
+
+def compile_gesture(spec, automap):
+    # a gesture is over by the time it runs, so its action sees a whole tap
+    build, lane, mode = ACTIONS[spec.get('action', 'color')]
+    action = build(spec, automap)
+    hold = spec.get('on', mode) == 'hold'
+
+    def tap(device, byte_signal):
+        action(device, byte_signal)
+        if hold:
+            action(device, [byte_signal[0], byte_signal[1], 0])
+
+    return action_lane(spec.get('lane', lane)), tap
+
+def compile_gestures(entries, automap, chords=()):
+    gestures = [None] * MIDI_NOTE_COUNT
+
+    def note_gestures(note):
+        if gestures[note] is None:
+            gestures[note] = Gestures()
+        return gestures[note]
+
+    for key, entry in entries.items():
+        if key == 'default':
+            continue
+
+        if 'long-press' in entry:
+            note_gestures(int(key)).long_press = compile_gesture(entry['long-press'], automap)
+        if 'double-tap' in entry:
+            note_gestures(int(key)).double_tap = compile_gesture(entry['double-tap'], automap)
+
+    for chord in chords:
+        notes = frozenset(chord['notes'])
+        action = compile_gesture(chord, automap)
+
+        for note in notes:
+            note_gestures(note).chords.append((notes, action))
+
+    return gestures
+
+
+# --------------------------------------------------------------
+# Validation
+# --------------------------------------------------------------
+
+def validate_colors(where, colors, count=None):
+    colors = [colors] if count is None else colors
+
+    if count is not None and (not isinstance(colors, list) or len(colors) != count):
+        raise LayoutError('{0}: expected a list of {1} colors'.format(where, count))
+
+    for color in colors:
+        if color not in COLORS:
+            raise LayoutError('{0}: unknown color {1!r}'.format(where, color))
+
+def validate_entries(section, entries, automap):
+    if 'default' not in entries or 'colors' not in entries['default']:
+        raise LayoutError('{0}: a default entry with colors is required'.format(section))
+
+    for key, entry in entries.items():
+        where = '{0}.{1}'.format(section, key)
+
+        if key != 'default':
+            note = int(key) if key.isdigit() else -1
+            valid = AUTOMAP_LED_INDEX if automap else GRID_LED_INDEX
+
+            if not 0 <= note < MIDI_NOTE_COUNT or valid[note] is None:
+                raise LayoutError('{0}: not a button on this row'.format(where))
+
+        if 'colors' in entry:
+            validate_colors(where + '.colors', entry['colors'], count=2)
+
+        validate_action(where, entry, automap)
+
+        for gesture in ['long-press', 'double-tap']:
+            if gesture not in entry:
+                continue
+            if key == 'default':
+                raise LayoutError('{0}: gestures are only for single buttons'.format(where))
+            if not isinstance(entry[gesture], dict):
+                raise LayoutError('{0}.{1}: expected an action entry'.format(where, gesture))
+
+            validate_action(where + '.' + gesture, entry[gesture], automap)
+
+def validate_action(where, entry, automap):
+    action = entry.get('action', 'color')
+
+    if action not in ACTIONS:
+        raise LayoutError('{0}: unknown action {1!r}'.format(where, action))
+    if action in AUTOMAP_ONLY_ACTIONS and not automap:
+        raise LayoutError('{0}: {1!r} only works on the automap row'.format(where, action))
+
+    for parameter in ACTION_PARAMETERS.get(action, []):
+        if parameter not in entry:
+            raise LayoutError('{0}: {1!r} needs a {2!r}'.format(where, action, parameter))
+
+    if action == 'macro':
+        validate_macro(where + '.steps', entry['steps'])
+
+    if entry.get('on', 'hold') not in ['hold', 'keydown']:
+        raise LayoutError('{0}: "on" must be "hold" or "keydown"'.format(where))
+
+def validate_chords(where, chords):
+    if not isinstance(chords, list):
+        raise LayoutError('{0}: expected a list of chords'.format(where))
+
+    for number, chord in enumerate(chords):
+        here = '{0}.{1}'.format(where, number)
+        notes = chord.get('notes')
+
+        on_grid = lambda note: isinstance(note, int) and 0 <= note < MIDI_NOTE_COUNT and GRID_LED_INDEX[note] is not None
+
+        if not isinstance(notes, list) or len(set(notes)) < 2 or not all(on_grid(note) for note in notes):
+            raise LayoutError('{0}.notes: expected two or more grid buttons'.format(here))
+
+        validate_action(here, chord, automap=False)
+
+def validate_macro(where, steps):
+    if not isinstance(steps, list) or not steps:
+        raise LayoutError('{0}: expected a list of steps'.format(where))
+
+    for number, step in enumerate(steps):
+        here = '{0}.{1}'.format(where, number)
+        kinds = [kind for kind in list(MACRO_STEPS) + ['delay'] if kind in step]
+
+        if len(kinds) != 1:
+            raise LayoutError('{0}: a step is one of "keys", "text", "audio" or "delay"'.format(here))
+
+        if 'delay' in step and not (isinstance(step['delay'], (int, float)) and step['delay'] >= 0):
+            raise LayoutError('{0}: "delay" must be a number of seconds'.format(here))
+
+        if 'audio' in step:
+            if step['audio'] not in AUDIO_STATE:
+                raise LayoutError('{0}: unknown audio device'.format(here))
+            if 'volume' not in step and 'mute' not in step:
+                raise LayoutError('{0}: an audio step needs a "volume" or "mute"'.format(here))
+            if step.get('mute', 'toggle') not in [True, False, 'toggle']:
+                raise LayoutError('{0}: "mute" must be true, false or "toggle"'.format(here))
+
+        if not isinstance(step.get('keys', ''), str) or not isinstance(step.get('text', ''), str):
+            raise LayoutError('{0}: "keys" and "text" must be strings'.format(here))
+
+def validate_bar(kind, bar, prefix=''):
+    where = prefix + 'bars.' + kind
+
+    if kind not in AUDIO_STATE:
+        raise LayoutError('{0}: unknown audio device'.format(where))
+
+    for field in ['main', 'staggered', 'toggle', 'max-volume', 'colors']:
+        if field not in bar:
+            raise LayoutError('{0}: missing {1!r}'.format(where, field))
+
+    main, staggered = bar['main'], bar['staggered']
+
+    for field in ['main', 'staggered']:
+        first, last = bar[field]
+        notes = list(range(first, last + 1)) + [bar['toggle']]
+
+        on_grid = lambda note: 0 <= note < MIDI_NOTE_COUNT and GRID_LED_INDEX[note] is not None
+
+        if last < first or not all(on_grid(note) for note in notes):
+            raise LayoutError('{0}.{1}: not a range of grid buttons'.format(where, field))
+
+    if staggered[1] - staggered[0] != main[1] - main[0] - 1:
+        raise LayoutError('{0}: the staggered row must be one key shorter than the main row'.format(where))
+
+    colors = bar['colors']
+    validate_colors(where + '.colors.default', colors.get('default'))
+    validate_colors(where + '.colors.no-volume', colors.get('no-volume'))
+    validate_colors(where + '.colors.toggle', colors.get('toggle'), count=2)
+    validate_colors(where + '.colors.levels', colors.get('levels'), count=main[1] - main[0] + 1)
+
+def validate_applications(where, applications):
+    for field in ['max-volume', 'colors']:
+        if field not in applications:
+            raise LayoutError('{0}: missing {1!r}'.format(where, field))
+
+    colors = applications['colors']
+    validate_colors(where + '.colors.default', colors.get('default'))
+    validate_colors(where + '.colors.no-volume', colors.get('no-volume'))
+    validate_colors(where + '.colors.empty', colors.get('empty'))
+    validate_colors(where + '.colors.toggle', colors.get('toggle'), count=2)
+    validate_colors(where + '.colors.levels', colors.get('levels'), count=APPLICATION_MAX_LEVEL + 1)
+
+def validate_monitors(where, monitors):
+    rows = monitors.get('rows')
+
+    if not isinstance(rows, list) or not 0 < len(rows) <= LAUNCHPAD_ROWS:
+        raise LayoutError('{0}.rows: expected a list of 1 to {1} sources'.format(where, LAUNCHPAD_ROWS))
+
+    for row, source in enumerate(rows):
+        if not isinstance(source, str) or not MONITOR_SOURCE.match(source):
+            raise LayoutError('{0}.rows.{1}: unknown source {2!r}'.format(where, row, source))
+
+    colors = monitors.get('colors', {})
+    validate_colors(where + '.colors.default', colors.get('default'))
+    validate_colors(where + '.colors.levels', colors.get('levels'), count=MONITOR_MAX_LEVEL)
+
+def compile_layout(spec):
+    # one Layout per page; every page shares the automap row
+    if not isinstance(spec, dict):
+        raise LayoutError('a layout is a table of "keys", "automap", "bars", "flash" and/or "pages"')
+
+    try:
+        automap = spec.get('automap', {})
+        validate_entries('automap', automap, automap=True)
+
+        pages = spec.get('pages', [spec])
+        if not isinstance(pages, list) or not pages:
+            raise LayoutError('"pages" must be a list of at least one page')
+
+        layouts = []
+        for number, page in enumerate(pages):
+            prefix = 'pages.{0}.'.format(number) if 'pages' in spec else ''
+
+            page = dict(page, automap=automap)
+            page.setdefault('flash', spec.get('flash', []))
+
+            validate_entries(prefix + 'keys', page.get('keys', {}), automap=False)
+
+            for kind, bar in page.get('bars', {}).items():
+                validate_bar(kind, bar, prefix)
+
+            if 'applications' in page:
+                validate_applications(prefix + 'applications', page['applications'])
+
+            if 'monitors' in page:
+                if 'applications' in page:
+                    raise LayoutError('{0}monitors: a page is either "applications" or "monitors"'.format(prefix))
+                validate_monitors(prefix + 'monitors', page['monitors'])
+
+            validate_chords(prefix + 'chords', page.get('chords', []))
+
+            layouts.append(Layout(page))
+
+        return layouts
+    except (AttributeError, IndexError, KeyError, TypeError) as error:
+        raise LayoutError('malformed layout ({0!r})'.format(error))
+
+def load_layout(path):
+    with open(path, 'rb') as layout_file:
+        text = layout_file.read().decode('utf-8')
+
+    if path.endswith('.toml'):
+        if tomllib is None:
+            raise LayoutError('TOML layouts need Python 3.11 or newer')
+        return compile_layout(tomllib.loads(text))
+
+    return compile_layout(json.loads(text))
+
+
+# --------------------------------------------------------------
+# Live reloading
+# --------------------------------------------------------------
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+INOTIFY_EVENT = struct.Struct('iIII') # wd, mask, cookie, name length
+
+def apply_layout(device, layouts):
+    # the writer waits until the new layout is fully painted, and then only
+    # sends the LEDs which actually changed
+    with LED_LOCK:
+        device.pages = [Page(layout) for layout in layouts]
+        device.select(device.page)
+        paint_pages(device)
+
+    flush_leds(device)
+
+def reload_layout(path):
+    try:
+        layouts = load_layout(path)
+    except (OSError, ValueError) as error:
+        print('Layout {0} not reloaded: {1}'.format(path, error))
+
+        automap_leds = range(GRID_LED_COUNT + SCENE_LED_COUNT, LED_COUNT)
+        for device in DEVICES:
+            if device.layout_path == path:
+                play_effect(device, alert(automap_leds, COLORS['BRIGHT_RED']))
+        return
+
+    for device in DEVICES:
+        if device.layout_path == path:
+            apply_layout(device, layouts)
+
+def inotify_events(directory):
+    library = ctypes.util.find_library('c')
+    libc = ctypes.CDLL(library, use_errno=True) if library else None
+
+    if libc is None or not hasattr(libc, 'inotify_init'):
+        return None
+
+    fd = libc.inotify_init()
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+
+    def events():
+        while True:
+            buffer = os.read(fd, 4096)
+            offset = 0
+
+            while offset < len(buffer):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                yield buffer[offset:offset + length].rstrip(b'\0').decode()
+                offset += length
+
+    return events()
+
+def watch_layout(path):
+    directory, name = os.path.split(os.path.abspath(path))
+
+    # editors often replace the file rather than write it, so watch its directory
+    events = inotify_events(directory)
+
+    if events is not None:
+        for changed in events:
+            if changed == name:
+                reload_layout(path)
+
+    modified = os.stat(path).st_mtime
+    while True:
+        time.sleep(LAYOUT_POLL_TIME)
+
+        try:
+            current = os.stat(path).st_mtime
+        except OSError:
+            continue
+
+        if current != modified:
+            modified = current
+            reload_layout(path)
+
+def start_layout_watcher(path):
+    watcher = threading.Thread(target=watch_layout, args=(path,), name='layout-watcher')
+    watcher.daemon = True
+    watcher.start()
+
+
+################################################################
+### Animation ##################################################
+################################################################
+
+# Effects are drawn over a device's frame rather than into it: the frame keeps
+# following the real state underneath, and a finished or interrupted effect
+# simply uncovers it again.
+
+LEVEL_STEP_TIME = 0.03 # per level of a volume bar moving to a new level
+
+ALERT_BLINKS = 3
+ALERT_BLINK_TIME = 0.15
+
+ANIMATION_LOCK = threading.Lock()
+ANIMATIONS_PENDING = threading.Event()
+
+class Keyframes(object):
+    # keyframes are (seconds from the start, [(led index, velocity)]), where a
+    # velocity of None lets whatever is underneath show through
+    def __init__(self, keyframes, duration, cumulative=False, interruptible=True, key=None):
+        self.times = [offset for offset, _ in keyframes]
+        self.leds = [leds for _, leds in keyframes]
+        self.duration = duration
+        self.cumulative = cumulative # keep showing earlier keyframes, e.g. for a sweep
+        self.interruptible = interruptible
+        self.key = key # a new effect with the same key replaces this one
+        self.start = None
+
+    def render(self, now):
+        elapsed = now - self.start
+        if elapsed >= self.duration:
+            return None
+
+        shown = bisect.bisect_right(self.times, elapsed)
+        if self.cumulative:
+            return [led for leds in self.leds[:shown] for led in leds]
+        return self.leds[shown - 1] if shown else []
+
+def level_transition(device, kind, old_level, new_level):
+    bar = device.layout.bars[kind]
+    step = 1 if new_level > old_level else -1
+    levels = range(old_level, new_level + step, step)
+
+    keyframes = [(n * LEVEL_STEP_TIME, bar['frames'][level]) for n, level in enumerate(levels)]
+    return Keyframes(keyframes, len(keyframes) * LEVEL_STEP_TIME, key=('level', kind))
+
+def alert(indices, velocity, blinks=ALERT_BLINKS):
+    keyframes = []
+    for blink in range(blinks):
+        keyframes.append((2 * blink * ALERT_BLINK_TIME, [(index, velocity) for index in indices]))
+        keyframes.append(((2 * blink + 1) * ALERT_BLINK_TIME, [(index, None) for index in indices]))
+
+    return Keyframes(keyframes, 2 * blinks * ALERT_BLINK_TIME, interruptible=False, key='alert')
+
+def render_effects(device, now):
+    # later effects are drawn over earlier ones; finished ones are dropped
+    overlay = [None] * LED_COUNT
+
+    for effect in list(device.effects):
+        leds = effect.render(now)
+        if leds is None:
+            device.effects.remove(effect)
+            continue
+
+        for index, velocity in leds:
+            if velocity is not None:
+                overlay[index] = velocity
+
+    device.overlay = overlay
+
+def play_effect(device, effect):
+    with ANIMATION_LOCK:
+        effect.start = time.perf_counter()
+
+        if effect.key is not None:
+            device.effects = [other for other in device.effects if other.key != effect.key]
+        device.effects.append(effect)
+
+        render_effects(device, effect.start)
+        ANIMATIONS_PENDING.set()
+
+def interrupt_effects(device):
+    with ANIMATION_LOCK:
+        device.effects = [effect for effect in device.effects if not effect.interruptible]
+        render_effects(device, time.perf_counter())
+
+    flush_leds(device)
+
+def animate():
+    frame_time = 1.0 / ANIMATION_FRAME_RATE
+
+    while True:
+        ANIMATIONS_PENDING.wait()
+        next_frame = time.perf_counter()
+
+        while ANIMATIONS_PENDING.is_set():
+            with timed('animation_frame_seconds'), ANIMATION_LOCK:
+                now = time.perf_counter()
+
+                for device in DEVICES:
+                    if device.effects:
+                        render_effects(device, now)
+                        flush_leds(device)
+
+                if not any(device.effects for device in DEVICES):
+                    ANIMATIONS_PENDING.clear()
+
+            # frames are due on a fixed schedule; a late one doesn't push the rest back
+            next_frame += frame_time
+            delay = next_frame - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_frame = time.perf_counter()
+
+def start_animator():
+    animator = threading.Thread(target=animate, name='animator')
+    animator.daemon = True
+    animator.start()
+
+
+################################################################
+### Light Sequences ############################################
+################################################################
+
+def boot_sequence(update_me=True, animate=True):
+    # the sweep plays over the real frame, so presses and state updates carry
+    # on underneath it, and a press cuts it short
+    for device in DEVICES:
+        paint_pages(device)
+
+        if animate:
+            play_effect(device, boot_sweep(device))
+            send_frame(device)
+        else:
+            # the device already shows its restored frame; only what changed is sent
+            flush_leds(device)
+
+    if update_me:
+        update()
+
+def boot_sweep(device):
+    sleep_time = 0.03
+    multiplier = .98
+    pause_time = 0.5
+
+    layout = device.layout
+
+    automap_note = lambda x: 104 + x
+    button_note = lambda x: floor(x/LAUNCHPAD_COLS)*16 + x%LAUNCHPAD_COLS
+
+    # everything starts dark, then lights up one LED at a time in its default color
+    keyframes = [(0, [(index, COLORS['OFF']) for index in range(LED_COUNT)])]
+    offset = 0
+
+    for x in range(LAUNCHPAD_COLS - 1):
+        note = automap_note(x)
+        keyframes.append((offset, [(AUTOMAP_LED_INDEX[note], layout.automap_default_velocities[False][note])]))
+        offset += sleep_time
+        sleep_time *= multiplier
+
+    for x in range(LAUNCHPAD_ROWS * LAUNCHPAD_COLS):
+        note = button_note(x)
+        velocity = button_velocity(note, layout.default_colors[1], False, layout.flash)
+        keyframes.append((offset, [(GRID_LED_INDEX[note], velocity)]))
+        offset += sleep_time
+        sleep_time *= multiplier
+
+    return Keyframes(keyframes, offset + pause_time, cumulative=True, key='boot')
+
+def paint_layout(device):
+    # every button in its resting color, then whatever the system state says
+    automap_signal = lambda x: [None, 104 + x, 0]
+    button_signal = lambda x: [None, floor(x/LAUNCHPAD_COLS)*16 + x%LAUNCHPAD_COLS, 0]
+
+    for x in range(LAUNCHPAD_COLS - 1):
+        color_automap_button(device, automap_signal(x))
+    for x in range(LAUNCHPAD_ROWS*LAUNCHPAD_COLS):
+        color_button(device, button_signal(x))
+
+    update_audio_visual(device)
+    update_key_lock_visual(device)
+    update_monitors_visual(device, force=True)
+
+def paint_pages(device):
+    for view in device.views():
+        paint_layout(view)
+
+################################################################
+### Persistent Updates #########################################
+################################################################
+
+def update():
+    # hot-plug events cut the wait short; only without them is the port list polled
+    wait_time = APPLICATION_REFRESH_TIME
+    if HOTPLUG_RETRIES:
+        wait_time = max(0, min(wait_time, HOTPLUG_RETRIES[0] - time.perf_counter()))
+
+    if PORTS_CHANGED.wait(wait_time):
+        PORTS_CHANGED.clear()
+
+        # the port may not be registered yet, so look again as it settles;
+        # later ticks make the retries, and an unrelated sound device only
+        # costs a few extra port list checks
+        now = time.perf_counter()
+        HOTPLUG_RETRIES[:] = [now + delay for delay in itertools.accumulate(HOTPLUG_SETTLE_TIMES)]
+
+        with timed('update_seconds', (('part', 'hotplug'),)):
+            if update_midi_ports():
+                del HOTPLUG_RETRIES[:]
+    elif HOTPLUG_RETRIES and HOTPLUG_RETRIES[0] <= time.perf_counter():
+        now = time.perf_counter()
+        HOTPLUG_RETRIES[:] = [due for due in HOTPLUG_RETRIES if due > now]
+
+        with timed('update_seconds', (('part', 'hotplug'),)):
+            if update_midi_ports():
+                del HOTPLUG_RETRIES[:]
+    elif not HOTPLUG_WATCHED.is_set():
+        with timed('update_seconds', (('part', 'port-check'),)):
+            update_midi_ports()
+
+    overdue = overdue_audio_kinds()
+    if overdue:
+        with timed('update_seconds', (('part', 'reconcile'),)):
+            for kind in overdue:
+                refresh_audio(kind)
+
+    with timed('update_seconds', (('part', 'flush'),)):
+        for device in DEVICES:
+            flush_leds(device)
+
+    if SNAPSHOT_WRITER is not None:
+        with timed('update_seconds', (('part', 'snapshot'),)):
+            SNAPSHOT_WRITER.write()
+
+    count('update_ticks_total')
+
+
+def update_audio_visual(device, kind=None, animate=False):
+    for bar_kind in device.layout.bars:
+        if kind in (None, bar_kind):
+            update_volume_visual(device, bar_kind, animate)
+
+    if kind in (None, 'sink-input'):
+        update_applications_visual(device)
+
+def repaint_audio_visual(kind=None, skip=None):
+    # the system state is shared, so every device shows it, on every page
+    for device in DEVICES:
+        for view in device.views():
+            if view is not skip:
+                update_audio_visual(view, kind, animate=view is device)
+        flush_leds(device)
+
+on_audio_state_change = repaint_audio_visual
+
+AUDIO_STATE_LISTENERS.append(on_audio_state_change)
+
+def update_volume_visual(device, kind, animate=False):
+    if AUDIO_STATE[kind]['volume'] is None:
+        return
+
+    level = fix_value_to_bounds(volume_level(device, kind), 0, device.layout.bars[kind]['max-level'])
+    shown = device.levels.get(kind)
+
+    # a jump made elsewhere (e.g. a mixer) slides the bar over instead
+    if animate and shown is not None and abs(level - shown) > 1:
+        play_effect(device, level_transition(device, kind, shown, level))
+
+    audio_volume_control(device, kind, level)
+    audio_mute_toggle(device, kind, toggle=False)
+
+def update_key_lock_visual(device):
+    for lock in LOCK_KEY_STATE:
+        update_lock_key_visual(device, lock)
+
+def repaint_lock_key_visual(locks):
+    for device in DEVICES:
+        for view in device.views():
+            for lock in locks:
+                update_lock_key_visual(view, lock)
+        flush_leds(device)
+
+on_lock_key_change = repaint_lock_key_visual
+
+LOCK_KEY_LISTENERS.append(on_lock_key_change)
+
+def update_lock_key_visual(device, lock):
+    for note in device.layout.lock_key_notes[lock]:
+        color_automap_button(device, generate_fake_midi_signal(note=note, on=bool(LOCK_KEY_STATE[lock])))
+
+def find_launchpad_port(midi, match, claimed=()):
+    for index, name in enumerate(midi.get_ports()):
+        if match in name and name not in claimed:
+            return index, name
+    return None, None
+
+def update_midi_ports():
+    changed = [update_midi_port(device) for device in DEVICES]
+    return any(changed)
+
+def update_midi_port(device):
+    # identical devices share a name, so skip ports other devices already use
+    claimed = [other.port_name for other in DEVICES if other is not device]
+
+    out_index, out_name = find_launchpad_port(device.midiout, device.name, claimed)
+    in_index, _ = find_launchpad_port(device.midiin, device.name, claimed)
+
+    if out_name == device.port_name:
+        return False
+
+    deactivate_ports(device)
+    device.port_name = None
+
+    if out_index is not None and in_index is not None:
+        activate_ports(device, out_index, in_index)
+        device.port_name = out_name
+
+        # the frame buffer still holds what the device last showed
+        send_frame(device)
+
+    return True
+
+def deactivate_ports(device):
+    with LED_LOCK:
+        device.midiout.close_port()
+        device.midiin.close_port()
+
+def activate_ports(device, out_index, in_index):
+    with LED_LOCK:
+        device.midiout.open_port(out_index)
+        device.midiin.open_port(in_index)
+
+    # rtmidi hands the device back to input_callback with every message
+    device.midiin.set_callback(input_callback, device)
+    reset_leds(device)
+
+
+# --------------------------------------------------------------
+# Hot-plug events
+# --------------------------------------------------------------
+
+PORTS_CHANGED = threading.Event()
+HOTPLUG_RETRIES = [] # when update() looks again after a hot-plug event, soonest first
+HOTPLUG_WATCHED = threading.Event() # set once uevents are coming in, so polling can stop
+
+NETLINK_KOBJECT_UEVENT = 15
+NETLINK_KERNEL_GROUP = 1
+
+def watch_hotplug_events():
+    try:
+        uevents = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        uevents.bind((0, NETLINK_KERNEL_GROUP))
+    except (AttributeError, OSError):
+        # no netlink here; update() keeps checking the port list on its own
+        return
+
+    HOTPLUG_WATCHED.set()
+
+    while True:
+        if b'SUBSYSTEM=sound' in uevents.recv(8192):
+            PORTS_CHANGED.set()
+
+def start_hotplug_watcher():
+    watcher = threading.Thread(target=watch_hotplug_events, name='hotplug-watcher')
+    watcher.daemon = True
+    watcher.start()
+
+################################################################
+### Action Dispatch ############################################
+################################################################
+
+class ActionLane(object):
+    # one worker per resource, so a slow action only delays its own lane
+    def __init__(self, name):
+        self.queue = queue.Queue()
+        self.pending = {} # coalesce key -> job still waiting in the queue
+        self.lock = threading.Lock()
+        self.labels = (('lane', name),)
+
+        # started on first use, so compiling the dispatch tables spawns nothing
+        self.thread = threading.Thread(target=self.run, name='lane-' + name)
+        self.thread.daemon = True
+
+    def submit(self, action, device, byte_signal, coalesce=None, received=None):
+        submitted = time.perf_counter()
+
+        with self.lock:
+            if not self.thread.is_alive():
+                self.thread.start()
+
+            if coalesce in self.pending:
+                # last writer wins; the job keeps its place in the queue
+                self.pending[coalesce][:5] = [action, device, byte_signal, received, submitted]
+                return
+
+            job = [action, device, byte_signal, received, submitted, coalesce]
+            if coalesce is not None:
+                self.pending[coalesce] = job
+
+        self.queue.put(job)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+
+            with self.lock:
+                action, device, byte_signal, received, submitted, coalesce = job
+                self.pending.pop(coalesce, None)
+
+            started = time.perf_counter()
+            observe('lane_wait_seconds', started - submitted, self.labels)
+
+            try:
+                action(device, byte_signal)
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+
+            observe('handler_seconds', time.perf_counter() - started, binding_labels(byte_signal))
+            flush_leds(device, received)
+
+            self.queue.task_done()
+
+ACTION_LANES = {}
+
+def action_lane(name):
+    if name not in ACTION_LANES:
+        ACTION_LANES[name] = ActionLane(name)
+    return ACTION_LANES[name]
+
+# --------------------------------------------------------------
+# Gestures
+# --------------------------------------------------------------
+
+class PadGesture(object):
+    # where one pad with gestures is in recognizing them
+    def __init__(self, gestures):
+        self.gestures = gestures
+        self.press = None # (byte_signal, received) held back until we know what it is
+        self.tap = None # a finished tap held back for DOUBLE_TAP_TIME
+        self.passed = False # the press went through as usual, so its release will too
+        self.consumed = False # a gesture used the press; its release is dropped
+        self.timer = None
+
+class GestureRecognizer(object):
+    # Sits between the input queue and dispatch. Pads without gestures go
+    # straight through; for the others a press is held back until it turns
+    # out to be a tap, a long press, a double tap or part of a chord. The
+    # waiting is done by timers on the wheel, so holding any number of pads
+    # costs one timer each and no threads.
+    def __init__(self):
+        self.pads = {} # (device, status, note) -> PadGesture
+        self.lock = threading.Lock()
+
+    def recognize(self, device, byte_signal, received):
+        # True when the gesture layer took the event
+        automap = is_automap_key(byte_signal)
+        layout = device.layout
+        gestures = (layout.automap_gestures if automap else layout.note_gestures)[byte_signal[1]]
+
+        if gestures is None and not self.pads:
+            return False
+
+        with self.lock:
+            key = (device, byte_signal[0], byte_signal[1])
+            pad = self.pads.get(key)
+
+            if pad is None:
+                if gestures is None:
+                    return False
+                pad = self.pads[key] = PadGesture(gestures)
+
+            if is_keydown(byte_signal):
+                self.pressed(device, key, pad, byte_signal, received)
+            else:
+                self.released(device, key, pad, byte_signal, received)
+
+            if pad.press is None and pad.tap is None and not pad.passed and not pad.consumed:
+                del self.pads[key]
+
+        return True
+
+    def pressed(self, device, key, pad, byte_signal, received):
+        gestures = pad.gestures
+
+        if pad.tap is not None:
+            self.stop_timer(pad)
+            pad.tap = None
+            pad.consumed = True
+            self.run(gestures.double_tap, device, byte_signal, received)
+            return
+
+        pad.press = (byte_signal, received)
+
+        for notes, action in gestures.chords:
+            members = [self.pads.get((device, key[1], note)) for note in notes]
+
+            if all(member is not None and member.press is not None for member in members):
+                for note, member in zip(notes, members):
+                    self.stop_timer(member)
+                    member.press = None
+                    member.consumed = True
+                    color_pad(device, [key[1], note, 0])
+
+                self.run(action, device, byte_signal, received)
+                return
+
+        color_pad(device, byte_signal)
+        flush_leds(device, received)
+
+        if gestures.long_press is not None:
+            self.start_timer(pad, LONG_PRESS_TIME, lambda: self.held(device, key, pad))
+        elif gestures.chords and gestures.double_tap is None:
+            self.start_timer(pad, CHORD_TIME, lambda: self.held(device, key, pad))
+
+    def held(self, device, key, pad):
+        # on the wheel's thread: the pad is still down after its timer
+        with self.lock:
+            if pad.press is None or self.pads.get(key) is not pad:
+                return
+
+            byte_signal, received = pad.press
+            pad.press = None
+            pad.timer = None
+
+            if pad.gestures.long_press is not None:
+                pad.consumed = True
+                color_pad(device, [byte_signal[0], byte_signal[1], 0])
+                self.run(pad.gestures.long_press, device, byte_signal, received)
+            else:
+                # the chord never came; from here on the pad is an ordinary one
+                pad.passed = True
+                dispatch_action(device, byte_signal, received)
+
+    def released(self, device, key, pad, byte_signal, received):
+        if pad.consumed or pad.passed:
+            if pad.passed:
+                dispatch_action(device, byte_signal, received)
+            pad.consumed = pad.passed = False
+            return
+
+        if pad.press is None:
+            # pressed before its layout had gestures
+            dispatch_action(device, byte_signal, received)
+            return
+
+        self.stop_timer(pad)
+        press, pad.press = pad.press, None
+
+        if pad.gestures.double_tap is None:
+            dispatch_action(device, *press)
+            dispatch_action(device, byte_signal, received)
+            return
+
+        pad.tap = (press, (byte_signal, received))
+        self.start_timer(pad, DOUBLE_TAP_TIME, lambda: self.tapped(device, key, pad))
+
+    def tapped(self, device, key, pad):
+        # on the wheel's thread: no second press came, so it was a plain tap
+        with self.lock:
+            if pad.tap is None or self.pads.get(key) is not pad:
+                return
+
+            (press, release), pad.tap = pad.tap, None
+            pad.timer = None
+            del self.pads[key]
+
+            dispatch_action(device, *press)
+            dispatch_action(device, *release)
+
+    def start_timer(self, pad, delay, callback):
+        pad.timer = TIMERS.schedule(delay, callback)
+
+    def stop_timer(self, pad):
+        if pad.timer is not None:
+            pad.timer.cancel()
+            pad.timer = None
+
+    def run(self, gesture, device, byte_signal, received):
+        lane, action = gesture
+        lane.submit(action, device, byte_signal, received=received)
+
+    def waiting(self):
+        with self.lock:
+            return any(pad.timer is not None for pad in self.pads.values())
+
+GESTURES = GestureRecognizer()
+
+
+INPUT_QUEUE = queue.Queue()
+
+def dispatch_input():
+    while True:
+        received, midi_in, device = INPUT_QUEUE.get()
+
+        if device.effects:
+            interrupt_effects(device)
+
+        observe('dispatch_wait_seconds', time.perf_counter() - received)
+        count('input_events_total')
+
+        # rtmidi passes (message, seconds since the previous message)
+        byte_signal, delta_time = midi_in
+        observe('input_interval_seconds', delta_time)
+
+        if SESSION_RECORDER is not None:
+            SESSION_RECORDER.record(midi_in)
+
+        if CONTROL_CLIENTS and publish_input(device, byte_signal):
+            INPUT_QUEUE.task_done()
+            continue
+
+        if not GESTURES.recognize(device, byte_signal, received):
+            dispatch_action(device, byte_signal, received)
+
+        INPUT_QUEUE.task_done()
+
+def dispatch_action(device, byte_signal, received):
+    layout = device.layout
+    actions = layout.automap_actions if is_automap_key(byte_signal) else layout.note_actions
+    lane, action, coalesce, preview, keydown_only = actions[byte_signal[1]]
+
+    if action is None or keydown_only and byte_signal[2] != ACTIVE_SIGNAL:
+        return
+
+    if preview is not None:
+        preview(device, byte_signal)
+        flush_leds(device, received)
+
+    lane.submit(action, device, byte_signal, coalesce, received)
+
+def start_input_dispatcher():
+    dispatcher = threading.Thread(target=dispatch_input, name='input-dispatcher')
+    dispatcher.daemon = True
+    dispatcher.start()
+
+
+################################################################
+### Simulation #################################################
+################################################################
+
+SIMULATED_SYSTEM = None # set by --simulate / --bench; see run_command
+
+VIRTUAL_PORT_NAME = 'Launchpad S (virtual)'
+VIRTUAL_HISTORY = 4096 # LED messages a virtual device remembers
+
+BENCH_PRESSES = 2000
+BENCH_PACED_PRESSES = 50 # one at a time, each written out before the next
+BENCH_TICKS = 8
+BENCH_PAGE_SWITCHES = 6
+
+class VirtualLaunchpad(object):
+    # an in-memory Launchpad S: remembers what it was sent and plays presses back
+    def __init__(self, name=VIRTUAL_PORT_NAME):
+        self.name = name
+        self.plugged = True
+        self.sent = collections.deque(maxlen=VIRTUAL_HISTORY)
+        self.last_message = None
+
+        self.midiout = VirtualMidiPort(self)
+        self.midiin = VirtualMidiPort(self)
+
+    def send(self, byte_signal):
+        port = self.midiin
+        if not self.plugged or not port.is_port_open() or port.callback is None:
+            return False
+
+        # rtmidi reports the time since the previous message along with each one
+        now = time.perf_counter()
+        delta_time = 0.0 if self.last_message is None else now - self.last_message
+        self.last_message = now
+
+        port.callback((list(byte_signal), delta_time), port.data)
+        return True
+
+    def press(self, note, automap=False):
+        return self.send([AUTOMAP_SIGNAL if automap else LIGHT_ON, note, ACTIVE_SIGNAL])
+
+    def release(self, note, automap=False):
+        return self.send([AUTOMAP_SIGNAL if automap else LIGHT_ON, note, 0])
+
+    def play(self, script, speed=1.0):
+        # script holds (seconds after the previous message, byte_signal); speed None = no waiting
+        for delay, byte_signal in script:
+            if speed and delay:
+                time.sleep(delay / speed)
+            self.send(byte_signal)
+
+
+class VirtualMidiPort(object):
+    # the part of rtmidi.MidiIn/MidiOut this script uses
+    def __init__(self, device):
+        self.device = device
+        self.open = False
+        self.callback = None
+        self.data = None
+
+    def get_ports(self):
+        return [self.device.name] if self.device.plugged else []
+
+    def open_port(self, _index=0):
+        self.open = True
+
+    def close_port(self):
+        self.open = False
+        self.callback = None
+
+    def is_port_open(self):
+        return self.open
+
+    def set_callback(self, callback, data=None):
+        self.callback = callback
+        self.data = data
+
+    def send_message(self, message):
+        if self.device.plugged:
+            self.device.sent.append(list(message))
+
+
+class SimulatedSystem(object):
+    # answers the commands a desktop session would, without starting anything
+    def __init__(self):
+        self.audio = {
+            'sink'  : { 'volume': 50, 'muted': False },
+            'source': { 'volume': 50, 'muted': False },
+        }
+        self.sink_inputs = {
+            1: { 'name': 'Firefox', 'volume': 100, 'muted': False },
+            2: { 'name': 'mpv', 'volume': 60, 'muted': False },
+        }
+        self.lock_keys = { 'num': False, 'caps': False }
+        self.commands = []
+
+    def run(self, args, output=False):
+        self.commands.append(list(args))
+
+        result = ''
+        if args[0] in ('pactl', 'pacmd'):
+            result = self.audio_command([str(arg) for arg in args[1:]])
+        elif args[0] == 'xset':
+            result = 'Caps Lock: {0}  Num Lock: {1}'.format(
+                *['on' if self.lock_keys[lock] else 'off' for lock in ('caps', 'num')]
+            )
+
+        return result if output else 0
+
+    def audio_command(self, args):
+        if args[:2] == ['list', 'sink-inputs']:
+            return ''.join(
+                'Sink Input #{0}\n\tMute: {1}\n\tVolume: front-left: {2} / {3}%\n'
+                '\tProperties:\n\t\tapplication.name = "{4}"\n'.format(
+                    index, 'yes' if state['muted'] else 'no',
+                    int(PULSE_VOLUME_NORM * state['volume'] / 100), state['volume'], state['name'],
+                )
+                for index, state in sorted(self.sink_inputs.items())
+            )
+
+        command = re.match(r'(get|set)-(sink|source|sink-input)-(volume|mute)$', args[0]) if args else None
+        if command is None:
+            return ''
+
+        verb, kind, field = command.groups()
+
+        # the second argument is the device name or the sink input's index
+        state = self.sink_inputs.get(int(args[1])) if kind == 'sink-input' else self.audio[kind]
+        if state is None:
+            return ''
+
+        if verb == 'get' and field == 'volume':
+            volume = state['volume']
+            return 'Volume: front-left: {0} / {1}%\n'.format(int(PULSE_VOLUME_NORM * volume / 100), volume)
+        if verb == 'get':
+            return 'Mute: {0}\n'.format('yes' if state['muted'] else 'no')
+
+        if field == 'volume':
+            state['volume'] = round(100 * int(args[2]) / PULSE_VOLUME_NORM)
+        else:
+            state['muted'] = args[2] == 'yes'
+        return ''
+
+    def spawn(self, args, **_kwargs):
+        if args[0] == 'pacmd':
+            return SimulatedShell(self)
+        # nothing long-lived (e.g. `pactl subscribe`) is simulated
+        raise OSError('{0} is not simulated'.format(args[0]))
+
+    def report_state(self):
+        # stands in for the audio and lock-key watchers
+        for kind in list(AUDIO_STATE) + ['sink-input']:
+            refresh_audio(kind)
+        set_lock_key_state(dict(self.lock_keys))
+
+
+class SimulatedShell(object):
+    # a `pacmd` child which is fed commands over stdin
+    def __init__(self, system):
+        self.system = system
+        self.stdin = self
+
+        # the greeting, then nothing: replies are not simulated
+        output, greeting = os.pipe()
+        os.write(greeting, b'Welcome to the simulated PulseAudio!\n')
+        os.close(greeting)
+        self.stdout = os.fdopen(output)
+
+    def poll(self):
+        return None
+
+    def write(self, line):
+        self.system.run(['pacmd'] + line.split())
+
+    def flush(self):
+        pass
+
+
+def wait_until_idle():
+    INPUT_QUEUE.join()
+    while GESTURES.waiting():
+        time.sleep(TIMER_TICK)
+    for lane in list(ACTION_LANES.values()):
+        lane.queue.join()
+    LED_WRITES.join()
+
+def process_spawns():
+    return sum(value for (name, _), value in COUNTERS.items() if name == 'process_spawns_total')
+
+def print_benchmark(name, value, unit, detail=''):
+    print('{0:<12} {1:>12.3f} {2:<10} {3}'.format(name, value, unit, detail).rstrip())
+
+def frame_cost(device):
+    # what write_frame sends: four buffer controls, two LEDs a message, and
+    # every blinking LED again
+    return 4 + LED_COUNT // 2 + sum(1 for velocity in device.sent if is_flashing_velocity(velocity))
+
+def run_benchmark(device, hardware, presses=BENCH_PRESSES, ticks=BENCH_TICKS):
+    # returns the checks which failed, so a regression fails the run
+    midi_messages = lambda: counter_value('midi_messages_total')
+    failures = []
+
+    def check(ok, message):
+        if not ok:
+            print('FAILED: ' + message)
+            failures.append(message)
+
+    # boot: until the first full frame is out; the sweep carries on by itself
+    messages, started = midi_messages(), time.perf_counter()
+    boot_sequence(update_me=False)
+    wait_until_idle()
+    print_benchmark('boot', time.perf_counter() - started, 's',
+                    '{0} MIDI messages'.format(midi_messages() - messages))
+
+    # input: press and release every bound grid button in turn, as fast as
+    # possible; repaints waiting to go out coalesce, so few messages are sent
+    notes = [note for note in range(MIDI_NOTE_COUNT) if device.layout.note_actions[note][1] is not None]
+    script = []
+    for press in range(presses // 2):
+        note = notes[press % len(notes)]
+        script += [(0, [LIGHT_ON, note, ACTIVE_SIGNAL]), (0, [LIGHT_ON, note, 0])]
+
+    messages, spawns, started = midi_messages(), process_spawns(), time.perf_counter()
+    hardware.play(script, speed=None)
+    wait_until_idle()
+    elapsed = time.perf_counter() - started
+    print_benchmark('input', len(script) / elapsed, 'events/s',
+                    '{0} events, {1:.2f} MIDI messages and {2:.2f} spawns per event'.format(
+                        len(script),
+                        (midi_messages() - messages) / len(script),
+                        (process_spawns() - spawns) / len(script),
+                    ))
+
+    # press: the same presses and releases one at a time, each written out before the next
+    messages, started = midi_messages(), time.perf_counter()
+    for press in range(BENCH_PACED_PRESSES):
+        note = notes[press % len(notes)]
+        for velocity in (ACTIVE_SIGNAL, 0):
+            hardware.play([(0, [LIGHT_ON, note, velocity])], speed=None)
+            wait_until_idle()
+    print_benchmark('press', (time.perf_counter() - started) * 1000 / BENCH_PACED_PRESSES, 'ms',
+                    '{0} presses, {1:.2f} MIDI messages per press'.format(
+                        BENCH_PACED_PRESSES, (midi_messages() - messages) / BENCH_PACED_PRESSES,
+                    ))
+
+    # idle ticks of the main loop, once the watchers have confirmed the presses' changes
+    SIMULATED_SYSTEM.report_state()
+    wait_until_idle()
+
+    messages, spawns = midi_messages(), process_spawns()
+    for _ in range(ticks):
+        update()
+    wait_until_idle()
+    print_benchmark('update', (midi_messages() - messages) / ticks, 'msgs/tick',
+                    '{0:.2f} spawns per tick over {1} ticks'.format((process_spawns() - spawns) / ticks, ticks))
+    check(midi_messages() == messages, 'idle update() ticks sent MIDI messages')
+    check(process_spawns() == spawns, 'idle update() ticks spawned processes')
+
+    # reconnect: unplug, then plug back in, each announced by a hot-plug event
+    hardware.plugged = False
+    PORTS_CHANGED.set()
+    update()
+    wait_until_idle()
+
+    hardware.plugged = True
+    messages, started = midi_messages(), time.perf_counter()
+    PORTS_CHANGED.set()
+    update()
+    wait_until_idle()
+    print_benchmark('reconnect', (time.perf_counter() - started) * 1000, 'ms',
+                    '{0} MIDI messages'.format(midi_messages() - messages))
+
+    # frame: one double-buffered repaint, once the boot sweep has finished
+    while device.effects:
+        time.sleep(TIMER_TICK)
+
+    messages = midi_messages()
+    send_frame(device)
+    wait_until_idle()
+    frame = midi_messages() - messages
+    print_benchmark('frame', frame, 'msgs', 'every LED, double-buffered')
+    check(frame == frame_cost(device), 'a frame took {0} MIDI messages, not {1}'.format(frame, frame_cost(device)))
+
+    # page: a switch is one frame, plus the page button's own press and release
+    lane = ACTION_LANES.get('pages')
+    page_notes = [
+        note for note in range(AUTOMAP_FIRST_NOTE, AUTOMAP_FIRST_NOTE + AUTOMAP_LED_COUNT)
+        if lane is not None and device.layout.automap_actions[note][0] is lane
+    ]
+    if len(device.pages) > 1 and page_notes:
+        switches = []
+        for _ in range(BENCH_PAGE_SWITCHES):
+            messages = midi_messages()
+            hardware.play([(0, [AUTOMAP_ON, page_notes[0], ACTIVE_SIGNAL]), (0, [AUTOMAP_ON, page_notes[0], 0])],
+                          speed=None)
+            wait_until_idle()
+            switches.append(midi_messages() - messages)
+
+            check(switches[-1] <= frame_cost(device) + 2,
+                  'a page switch took {0} MIDI messages, more than one frame ({1}) and the button'.format(
+                      switches[-1], frame_cost(device),
+                  ))
+        print_benchmark('page', sum(switches) / len(switches), 'msgs',
+                        'per switch, {0} switches of {1} pages'.format(len(switches), len(device.pages)))
+
+    return failures
+
+
+################################################################
+### Sessions ###################################################
+################################################################
+
+# a session file is SESSION_MAGIC followed by one record per incoming message:
+# the rtmidi delta time in microseconds, the message length, then its bytes
+SESSION_MAGIC = b'LPSESS\x00\x01'
+SESSION_RECORD = struct.Struct('<IB')
+SESSION_MAX_DELTA = 2 ** 32 - 1
+
+SESSION_RECORDER = None # set by --record
+
+class SessionRecorder(object):
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(SESSION_MAGIC)
+        self.lock = threading.Lock()
+
+    def record(self, midi_in):
+        message, delta_time = midi_in
+        delta = min(int(round(delta_time * 1000000)), SESSION_MAX_DELTA)
+
+        # flushed record by record, so a driver killed mid-session keeps all but
+        # perhaps the message it was writing
+        with self.lock:
+            self.file.write(SESSION_RECORD.pack(delta, len(message)) + bytes(message))
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_session(path):
+    with open(path, 'rb') as session:
+        if session.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+            raise ValueError('{0} is not a recorded session'.format(path))
+
+        while True:
+            header = session.read(SESSION_RECORD.size)
+            if len(header) < SESSION_RECORD.size:
+                return # a recording cut short loses at most its last message
+
+            delta, length = SESSION_RECORD.unpack(header)
+            message = session.read(length)
+            if len(message) < length:
+                return
+
+            yield delta / 1000000, list(message)
+
+def replay_session(device, path, speed=1.0):
+    # through input_callback, exactly as rtmidi would deliver it; speed 0 = no waiting
+    replayed = 0
+    started = due = time.perf_counter()
+
+    for delta_time, message in read_session(path):
+        if speed:
+            # sleep towards an absolute schedule so oversleeping doesn't add up
+            due += delta_time / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+        input_callback((message, delta_time), device)
+        replayed += 1
+
+    return replayed, time.perf_counter() - started
+
+
+################################################################
+### Snapshots ##################################################
+################################################################
+
+# A snapshot is a small JSON file with the volume, mute and lock-key state and
+# every page's frame, one hex byte per LED (SNAPSHOT_NO_LED where nothing was
+# painted). A restart paints it at once and the watchers correct it afterwards.
+SNAPSHOT_NO_LED = 0xff
+
+SNAPSHOT_WRITER = None
+
+def encode_frame(frame):
+    return bytes(SNAPSHOT_NO_LED if velocity is None else velocity for velocity in frame).hex()
+
+def decode_frame(text):
+    frame = [None if velocity == SNAPSHOT_NO_LED else velocity for velocity in bytes.fromhex(text)]
+
+    if len(frame) != LED_COUNT:
+        raise ValueError('a frame has {0} LEDs'.format(LED_COUNT))
+    return frame
+
+def take_snapshot():
+    return {
+        'audio': { kind: dict(state) for kind, state in AUDIO_STATE.items() },
+        'lock-keys': dict(LOCK_KEY_STATE),
+        'devices': [
+            {
+                'name': device.name,
+                'layout': device.layout_path,
+                'page': device.page,
+                'frames': [encode_frame(page.frame) for page in device.pages],
+            }
+            for device in DEVICES
+        ],
+    }
+
+def restore_snapshot(path):
+    # False when there was nothing usable to restore
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+
+        audio, lock_keys = snapshot['audio'], snapshot['lock-keys']
+        devices = []
+
+        # a device only gets its frames back if it runs the same layout file as before
+        for device, saved in zip(DEVICES, snapshot['devices']):
+            if [saved['name'], saved['layout']] == [device.name, device.layout_path] \
+                    and len(saved['frames']) == len(device.pages):
+                devices.append((device, saved['page'], [decode_frame(frame) for frame in saved['frames']]))
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+    for kind, state in AUDIO_STATE.items():
+        state.update({ field: audio.get(kind, {}).get(field) for field in state })
+
+    LOCK_KEY_STATE.update({ lock: lock_keys.get(lock) for lock in LOCK_KEY_STATE })
+
+    for device, page, frames in devices:
+        for view, frame in zip(device.pages, frames):
+            view.frame[:] = frame
+        device.select(page)
+
+    return True
+
+class SnapshotWriter(object):
+    # rewritten from update() now and then, and once more on the way out
+    def __init__(self, path):
+        self.path = path
+        self.written = None
+        self.stamp = time.perf_counter()
+        self.failed = False # only the first failure is reported
+
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        except OSError:
+            pass # reported by the first write
+
+    def write(self, force=False):
+        if not force and time.perf_counter() - self.stamp < SNAPSHOT_WRITE_TIME:
+            return
+        self.stamp = time.perf_counter()
+
+        text = json.dumps(take_snapshot(), sort_keys=True)
+        if text == self.written:
+            return
+
+        # written aside and renamed, so a crash never leaves half a snapshot
+        try:
+            with open(self.path + '.tmp', 'w') as snapshot_file:
+                snapshot_file.write(text)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as error:
+            if not self.failed:
+                print('Snapshot {0} not written: {1}'.format(self.path, error))
+            self.failed = True
+            return
+
+        self.written = text
+        self.failed = False
+
+
+################################################################
+### Control Socket #############################################
+################################################################
+
+# Other programs share the device through a Unix socket rather than opening
+# their own MIDI reader. Every line sent is one JSON request, or a list of
+# them as a batch; events come back as one JSON object per line.
+#   {"op": "subscribe"} / {"op": "unsubscribe"}      every press and release
+#   {"op": "bind", "note": 112, "automap": false}    that button's events go to
+#   {"op": "unbind", "note": 112, "automap": false}  this client instead of its action
+#   {"op": "leds", "grid": [[4, "BRIGHT_RED"]], "automap": [[104, 60]]}
+#   {"op": "frame", "leds": [...]}                   all LEDs in rapid-update order, null keeps one
+# "device" picks a device by its place on the command line (default 0).
+
+CONTROL_CLIENTS = []
+CONTROL_BINDINGS = {} # (device, automap, note) -> client
+
+CONTROL_OUTBOX_SIZE = 4096 # lines a client may fall behind by before it is disconnected
+CONTROL_LOCK = threading.Lock()
+
+class ControlError(ValueError):
+    pass
+
+class ControlClient(object):
+    def __init__(self, connection):
+        self.connection = connection
+        # a slow reader must not hold up the dispatcher, nor pile up lines forever
+        self.outbox = queue.Queue(maxsize=CONTROL_OUTBOX_SIZE)
+        self.subscribed = False
+        self.dropped = False
+
+    def send(self, message):
+        try:
+            self.outbox.put_nowait(json.dumps(message) + '\n')
+        except queue.Full:
+            self.disconnect()
+
+    def disconnect(self):
+        # its reader then sees the end of the connection and cleans up as usual
+        if self.dropped:
+            return
+        self.dropped = True
+
+        count('control_clients_dropped_total')
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def write(self):
+        while True:
+            line = self.outbox.get()
+            if line is None:
+                return
+
+            try:
+                self.connection.sendall(line.encode())
+            except OSError:
+                return
+
+def control_device(request):
+    number = request.get('device', 0)
+
+    if not isinstance(number, int) or not 0 <= number < len(DEVICES):
+        raise ControlError('no device {0!r}'.format(number))
+    return DEVICES[number]
+
+def control_velocity(color):
+    if color in COLORS:
+        return COLORS[color]
+    if isinstance(color, int) and 0 <= color < 128:
+        return color
+    raise ControlError('unknown color {0!r}'.format(color))
+
+def control_led_index(note, automap):
+    valid = AUTOMAP_LED_INDEX if automap else GRID_LED_INDEX
+
+    if not isinstance(note, int) or not 0 <= note < MIDI_NOTE_COUNT or valid[note] is None:
+        raise ControlError('{0!r} is not a button on this row'.format(note))
+    return valid[note]
+
+def control_binding(request):
+    automap = bool(request.get('automap', False))
+    control_led_index(request['note'], automap)
+
+    return control_device(request), automap, request['note']
+
+def control_subscribe(client, _request):
+    client.subscribed = True
+
+def control_unsubscribe(client, _request):
+    client.subscribed = False
+
+def control_bind(client, request):
+    binding = control_binding(request)
+
+    with CONTROL_LOCK:
+        CONTROL_BINDINGS[binding] = client
+
+def control_unbind(client, request):
+    binding = control_binding(request)
+
+    with CONTROL_LOCK:
+        if CONTROL_BINDINGS.get(binding) is client:
+            del CONTROL_BINDINGS[binding]
+
+def control_leds(_client, request):
+    device = control_device(request)
+
+    leds = [
+        (control_led_index(note, automap), control_velocity(color))
+        for section, automap in [('grid', False), ('automap', True)]
+        for note, color in request.get(section, [])
+    ]
+
+    paint_leds(device, leds)
+    flush_leds(device)
+
+def control_frame(_client, request):
+    device = control_device(request)
+    colors = request['leds']
+
+    if not isinstance(colors, list) or len(colors) != LED_COUNT:
+        raise ControlError('a frame is a list of {0} LEDs'.format(LED_COUNT))
+
+    leds = [(index, control_velocity(color)) for index, color in enumerate(colors) if color is not None]
+
+    with LED_LOCK:
+        paint_leds(device, leds)
+
+    send_frame(device)
+
+CONTROL_OPS = {
+    'subscribe': control_subscribe,
+    'unsubscribe': control_unsubscribe,
+    'bind': control_bind,
+    'unbind': control_unbind,
+    'leds': control_leds,
+    'frame': control_frame,
+}
+
+def handle_control_line(client, line):
+    try:
+        requests = json.loads(line)
+
+        for request in requests if isinstance(requests, list) else [requests]:
+            if not isinstance(request, dict) or request.get('op') not in CONTROL_OPS:
+                raise ControlError('unknown request {0!r}'.format(request))
+
+            CONTROL_OPS[request['op']](client, request)
+    except (ValueError, KeyError, TypeError) as error:
+        client.send({ 'error': str(error) })
+
+def publish_input(device, byte_signal):
+    # tells whether a client has bound the button, in which case it gets the
+    # event instead of the button's own action
+    automap = is_automap_key(byte_signal)
+    note = byte_signal[1]
+
+    owner = CONTROL_BINDINGS.get((device, automap, note))
+    event = None
+
+    for client in list(CONTROL_CLIENTS):
+        if client.subscribed or client is owner:
+            if event is None:
+                event = {
+                    'event': 'press' if is_keydown(byte_signal) else 'release',
+                    'device': DEVICES.index(device),
+                    'note': note,
+                    'automap': automap,
+                    'velocity': byte_signal[2],
+                }
+            client.send(event)
+
+    return owner is not None
+
+def serve_control_client(connection):
+    client = ControlClient(connection)
+
+    writer = threading.Thread(target=client.write, name='control-writer')
+    writer.daemon = True
+    writer.start()
+
+    with CONTROL_LOCK:
+        CONTROL_CLIENTS.append(client)
+
+    try:
+        with connection, connection.makefile('r', encoding='utf-8') as lines:
+            for line in lines:
+                if line.strip():
+                    handle_control_line(client, line)
+    except (OSError, UnicodeDecodeError):
+        pass
+    finally:
+        # whatever the client bound goes back to the layout
+        with CONTROL_LOCK:
+            CONTROL_CLIENTS.remove(client)
+            for binding in [binding for binding, owner in CONTROL_BINDINGS.items() if owner is client]:
+                del CONTROL_BINDINGS[binding]
+
+        try:
+            client.outbox.put_nowait(None)
+        except queue.Full:
+            pass # the writer stops on its own, as the connection is gone
+
+def prepare_control_socket_directory(path):
+    # a directory someone else made could let them swap the socket for their own
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return os.stat(directory).st_uid in (os.getuid(), 0)
+
+def control_socket_in_use(path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except OSError:
+        return False # nothing there, or a socket left behind by a driver which died
+    finally:
+        probe.close()
+
+def serve_control_socket(path):
+    # only a leftover socket is replaced; main() refuses to start next to a live one
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+
+    # subscribers see every press, so only our own user may connect; nobody can
+    # before listen(), whatever the umask made of the socket
+    os.chmod(path, 0o600)
+    server.listen(8)
+
+    while True:
+        connection, _ = server.accept()
+
+        worker = threading.Thread(target=serve_control_client, args=(connection,), name='control-client')
+        worker.daemon = True
+        worker.start()
+
+def start_control_socket(path):
+    server = threading.Thread(target=serve_control_socket, args=(path,), name='control-socket')
+    server.daemon = True
+    server.start()
+
+
+################################################################
+### Application Loop ###########################################
+################################################################
+
+def input_callback(midi_in, device):
+    # runs on rtmidi's thread: note the arrival time and hand the message over
+    INPUT_QUEUE.put((time.perf_counter(), midi_in, device))
+
+def parse_device(spec, default_layout):
+    # NAME or NAME=LAYOUT
+    name, _, layout_path = spec.partition('=')
+    return name or LAUNCHPAD_PORT_NAME, os.path.abspath(layout_path or default_layout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Launchpad S system controller')
+    parser.add_argument(
+        '--layout', default=LAYOUT_FILE,
+        help='JSON or TOML layout file, reloaded whenever it changes (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--device', action='append', metavar='NAME[=LAYOUT]',
+        help='drive the first free MIDI port whose name contains NAME, optionally with '
+             'its own layout; repeat for more devices (default: {0})'.format(LAUNCHPAD_PORT_NAME),
+    )
+    parser.add_argument(
+        '--control-socket', default=CONTROL_SOCKET_FILE, metavar='PATH',
+        help='Unix socket other programs use to share the device; empty to disable (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--metrics-file', metavar='PATH',
+        help='rewrite a Prometheus text file with latency metrics every {0:g}s'.format(METRICS_WRITE_TIME),
+    )
+    parser.add_argument(
+        '--metrics-socket', metavar='PATH',
+        help='serve the same metrics to anyone connecting to this Unix socket',
+    )
+    parser.add_argument(
+        '--snapshot', metavar='PATH',
+        help='keep the last frames and system state here and show them straight away on start; '
+             'empty to disable (default: {0}, or none with --simulate)'.format(SNAPSHOT_FILE),
+    )
+    parser.add_argument(
+        '--boot-animation', choices=['auto', 'always', 'never'], default='auto',
+        help='play the boot sweep; "auto" plays it only when there was no snapshot to show (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--midi-rate', type=int, default=MIDI_MESSAGE_RATE, metavar='N',
+        help='at most N MIDI messages a second to each device; 0 for no limit (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--simulate', action='store_true',
+        help='run against a virtual Launchpad and a simulated desktop session',
+    )
+    parser.add_argument(
+        '--bench', action='store_true',
+        help='measure boot, input, update, reconnect, frame and page switch costs on the simulator, then exit',
+    )
+    parser.add_argument(
+        '--record', metavar='FILE',
+        help='log every incoming message with its timing to a session file',
+    )
+    parser.add_argument(
+        '--replay', metavar='FILE',
+        help='feed a recorded session through the usual dispatch, then exit',
+    )
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='replay speed, e.g. 4 for 4x; 0 replays as fast as possible (default: %(default)g)',
+    )
+    args = parser.parse_args()
+
+    if rtmidi is None and not (args.simulate or args.bench):
+        parser.error('python-rtmidi is needed to talk to a Launchpad; try --simulate')
+
+    if args.control_socket and not prepare_control_socket_directory(args.control_socket):
+        parser.error('{0} belongs to another user; pass --control-socket to use a different '
+                     'path (or "" for none)'.format(os.path.dirname(args.control_socket)))
+
+    if args.control_socket and control_socket_in_use(args.control_socket):
+        parser.error('another driver is listening on {0}; pass --control-socket to use '
+                     'a different path (or "" for none)'.format(args.control_socket))
+
+    simulated = args.simulate or args.bench
+    MIDI_MESSAGE_RATE = args.midi_rate
+
+    if simulated:
+        SIMULATED_SYSTEM = SimulatedSystem()
+        KEY_INJECTOR = RecordingInjector()
+    else:
+        KEY_INJECTOR = open_key_injector()
+
+    layouts = {} # devices sharing a layout file share its compiled tables
+    hardware = []
+
+    for number, spec in enumerate(args.device or [LAUNCHPAD_PORT_NAME], 1):
+        name, layout_path = parse_device(spec, args.layout)
+
+        if layout_path not in layouts:
+            layouts[layout_path] = load_layout(layout_path)
+
+        if simulated:
+            hardware.append(VirtualLaunchpad('{0} (virtual {1})'.format(name, number)))
+            midiout, midiin = hardware[-1].midiout, hardware[-1].midiin
+        else:
+            # pylint: disable=no-member
+            midiout, midiin = rtmidi.MidiOut(), rtmidi.MidiIn()
+
+        DEVICES.append(Device(name, layouts[layout_path], layout_path, midiout, midiin))
+
+    if args.record:
+        SESSION_RECORDER = SessionRecorder(args.record)
+
+    # simulated runs leave the real snapshot alone unless told otherwise
+    snapshot_path = args.snapshot if args.snapshot is not None else (None if simulated else SNAPSHOT_FILE)
+    restored = False
+
+    if snapshot_path:
+        # before the ports open, so connecting sends the restored frame
+        restored = restore_snapshot(snapshot_path)
+        SNAPSHOT_WRITER = SnapshotWriter(snapshot_path)
+
+    start_metrics_export(args.metrics_file, args.metrics_socket)
+    start_led_writer()
+    start_animator()
+    start_input_dispatcher()
+    start_hotplug_watcher()
+
+    if args.control_socket:
+        start_control_socket(args.control_socket)
+
+    for layout_path in layouts:
+        start_layout_watcher(layout_path)
+
+    update_midi_ports()
+
+    start_system_load_watcher()
+
+    if SIMULATED_SYSTEM is None:
+        start_audio_watcher()
+        start_lock_key_watcher()
+    else:
+        SIMULATED_SYSTEM.report_state()
+
+    failures = []
+
+    try:
+        if args.bench:
+            failures = run_benchmark(DEVICES[0], hardware[0])
+        elif args.replay:
+            for device in DEVICES:
+                paint_pages(device)
+                send_frame(device)
+
+            replayed, elapsed = replay_session(DEVICES[0], args.replay, args.speed)
+            wait_until_idle()
+            print('Replayed {0} messages in {1:.3f}s'.format(replayed, elapsed))
+        else:
+            boot_sequence(animate={'auto': not restored, 'always': True, 'never': False}[args.boot_animation])
+
+            while True:
+                update()
+    except KeyboardInterrupt:
+        pass
+
+    if SESSION_RECORDER is not None:
+        SESSION_RECORDER.close()
+
+    if SNAPSHOT_WRITER is not None:
+        SNAPSHOT_WRITER.write(force=True)
+
+    for device in DEVICES:
+        reset_leds(device)
+    LED_WRITES.join()
+
+    if failures:
+        raise SystemExit('{0} benchmark check(s) failed'.format(len(failures)))